@@ -0,0 +1,57 @@
+"""
+Records per second hydrated from an xml collection, serially and with each ParallelHydration backend.
+
+    python benchmarks/hydration_benchmark.py [records] [workers]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from StringIO import StringIO
+from xml_models import Model, CharField, IntField, DateField
+from xml_models import xpath_twister
+from common_models import ParallelHydration
+
+class Address(Model):
+    number = IntField(xpath='/address/number')
+    street = CharField(xpath='/address/street')
+    city = CharField(xpath='/address/city')
+    country = CharField(xpath='/address/country')
+    postcode = CharField(xpath='/address/postcode')
+    updated = DateField(xpath='/address/updated')
+
+def feed(records):
+    record = ("<address><number>%d</number><street>Early Drive</street><city>Calgary</city><country>Canada</country>"
+              "<postcode>T2P 1J9</postcode><updated>2010-04-01T12:30:00</updated></address>")
+    return "<addresses>" + "".join([record % i for i in xrange(records)]) + "</addresses>"
+
+def read(address):
+    return (address.number, address.street, address.city, address.country, address.postcode, address.updated)
+
+def serial(body):
+    for dom in Address._records(StringIO(body)):
+        yield Address(dom=dom)
+
+def parallel(hydration):
+    return lambda body: hydration.map(Address, Address._raw_records(StringIO(body)))
+
+def run(hydrate, body, records):
+    start = time.time()
+    for address in hydrate(body):
+        read(address)
+    return records / (time.time() - start)
+
+def main(records=20000, workers=None):
+    body = feed(records)
+    threads = ParallelHydration('thread', workers=workers)
+    processes = ParallelHydration('process', workers=workers)
+    print "%d records, %d workers, parsed with %s" % (records, threads.workers, xpath_twister.lxml_available and "lxml" or "minidom")
+    try:
+        print "serial:            %8.1f records/sec" % run(serial, body, records)
+        print "thread hydration:  %8.1f records/sec" % run(parallel(threads), body, records)
+        print "process hydration: %8.1f records/sec" % run(parallel(processes), body, records)
+    finally:
+        threads.close()
+        processes.close()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
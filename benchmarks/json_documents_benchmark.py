@@ -0,0 +1,54 @@
+"""
+Time and peak memory taken to load a large nested json document into a model, and to read fields through it.
+The document is written to a file and loaded by a child process, so the peak resident size is the model's own.
+
+    python benchmarks/json_documents_benchmark.py [records]
+"""
+import os, sys, time, json, resource, subprocess, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from json_models import Model, CharField, IntField
+
+class Catalogue(Model):
+    name = CharField(path='name')
+    first_city = CharField(path='summary.location.city')
+    missing = IntField(path='summary.missing.count')
+
+def document(records):
+    record = {'number': 1, 'street': 'Early Drive', 'location': {'city': 'Calgary', 'country': {'name': 'Canada', 'code': 'CA'}},
+              'tags': ['a', 'b'], 'owner': {'name': 'Kermit', 'contact': {'email': 'k@example.com', 'phone': '555'}}}
+    return json.dumps({'name': 'catalogue', 'summary': record, 'records': dict([('r%d' % i, dict(record, number=i)) for i in xrange(records)])})
+
+def peak_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(path):
+    text = open(path).read()
+    before = peak_kb()
+    start = time.time()
+    model = Catalogue(text)
+    loaded = time.time() - start
+    start = time.time()
+    for i in xrange(100000):
+        model.first_city
+        model.missing
+    read = (time.time() - start) / 200000 * 1000000000
+    grown = peak_kb() - before
+    unchanged = json.loads(str(model)) == json.loads(text)
+    print "load: %8.1f ms   peak growth: %8d KB   field read: %6.1f ns   document unchanged by reads: %s" % (
+        loaded * 1000, grown, read, unchanged)
+
+def main(records=20000):
+    text = document(records)
+    print "%d records, %d bytes of json" % (records, len(text))
+    saved = tempfile.NamedTemporaryFile(suffix='.json')
+    saved.write(text)
+    saved.flush()
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), 'measure', saved.name])
+    saved.close()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['measure']:
+        measure(sys.argv[2])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+"""
+Cost of reading and setting json model fields, a top level and a nested one, on many instances.
+
+    python benchmarks/json_fields_benchmark.py [instances]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from json_models import Model, CharField, IntField
+
+class Address(Model):
+    number = IntField(path='number')
+    city = CharField(path='location.city')
+
+def instances(count):
+    record = {'number': 10, 'location': {'city': 'Calgary'}}
+    return [Address(json=record) for i in xrange(count)]
+
+def run(action, models):
+    start = time.time()
+    for model in models:
+        action(model)
+    return (time.time() - start) / len(models) * 1000000000
+
+def main(count=1000000):
+    models = instances(count)
+    print "%d instances" % count
+    print "read number:        %6.1f ns/access" % run(lambda model: model.number, models)
+    print "read location.city: %6.1f ns/access" % run(lambda model: model.city, models)
+    def set_city(model):
+        model.city = 'Edmonton'
+    print "set location.city:  %6.1f ns/access" % run(set_city, models)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,38 @@
+"""
+Requests per second against the stub server, with and without the keep-alive connection pool.
+
+    python benchmarks/pool_benchmark.py [requests]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stubserver
+from stubserver import StubServer
+from rest_client import Client, ConnectionPool
+
+stubserver.StubResponse.log_message = lambda self, *args: None
+
+def run(client, requests):
+    start = time.time()
+    for i in xrange(requests):
+        client.GET("/address/%s" % i).content.read()
+    return requests / (time.time() - start)
+
+def main(requests=2000):
+    server = StubServer(8998, keep_alive=True)
+    server.run()
+    server.expect(method="GET", url="/address/\d+$", times=None).and_return(mime_type="text/xml",
+            content="<address><number>12</number><street>Early Drive</street><city>Calgary</city></address>")
+    pool = ConnectionPool()
+    try:
+        unpooled = run(Client("http://localhost:8998", pool=None), requests)
+        pooled = run(Client("http://localhost:8998", pool=pool), requests)
+    finally:
+        pool.clear()
+        server.stop()
+    print "%d GETs" % requests
+    print "without pooling: %8.1f requests/sec" % unpooled
+    print "with pooling:    %8.1f requests/sec (%d connections opened)" % (pooled, pool.created)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+Per record cost of building xml models from a collection, serialising each record and parsing it again
+as queries used to, against building the model on the record as it was parsed from the collection.
+
+    python benchmarks/xml_records_benchmark.py [records]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from StringIO import StringIO
+from xml.etree import ElementTree as et
+from xml_models import Model, CharField, IntField
+from xml_models import xpath_twister
+
+class Address(Model):
+    number = IntField(xpath='/address/number')
+    street = CharField(xpath='/address/street')
+    city = CharField(xpath='/address/city')
+
+def feed(records):
+    record = "<address><number>%d</number><street>Early Drive</street><city>Calgary</city></address>"
+    return "<addresses>" + "".join([record % i for i in xrange(records)]) + "</addresses>"
+
+def reserialised(body):
+    tree = et.iterparse(StringIO(body), ['start', 'end'])
+    tree.next()
+    evt, child = tree.next()
+    for event, elem in tree:
+        if event == 'end' and elem.tag == child.tag:
+            result = et.tostring(elem)
+            elem.clear()
+            yield Address(result)
+
+def parsed_once(body):
+    for dom in Address._records(StringIO(body)):
+        yield Address(dom=dom)
+
+def run(build, body, records):
+    start = time.time()
+    for address in build(body):
+        address.number
+    return (time.time() - start) / records * 1000000
+
+def main(records=100000):
+    body = feed(records)
+    print "%d records, parsed with %s" % (records, xpath_twister.lxml_available and "lxml" or "minidom")
+    print "serialised and parsed again: %8.1f us/record" % run(reserialised, body, records)
+    print "parsed once:                 %8.1f us/record" % run(parsed_once, body, records)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
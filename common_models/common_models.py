@@ -1,16 +1,41 @@
-import rest_client
-from xml.etree import ElementTree as et
+import rest_client, sys, re, json, threading, time, urllib, urlparse, itertools, multiprocessing, Queue
+from rest_client.instrumentation import monotonic
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, deque
 
 class ModelManager(object):
     """Handles what can be queried for, and acts as the entry point for querying.  There is an instance per model that is used
     in the django style of Model.objects.get(attr1=value, attr2=value2) for single results, or
     Model.objects.filter(attr1=value1,attr2=value2) for multiple results.  As with Django, you can chain filters together, i.e.
     Model.objects.filter(attr1=value1).filter(attr2=value2)  Filter is not evaluated until you try to iterate over the results or
-    get a count of the results."""
+    get a count of the results.  Every query made through the manager shares its client, and so its pooled connections.
+    If the service reports the size of a result set in a count_header, counts are read from it, with a HEAD request
+    when head_count is True, rather than by reading through the results.  If the service pages its results, set a pagination,
+    e.g. OffsetPagination(page_size=50), and the finders' urls are fetched a page at a time as the results are needed, with
+    up to prefetch pages fetched ahead in the background while iterating.  Gets are served from an InstanceCache when
+    one is entered on the current thread, or else set as the manager's instance_cache.  Where the records of a collection
+    sit deeper in the response, set record_path, e.g. '/Envelope/Body/Items/Item' for xml or 'results.*' for json.
+    With a ParallelHydration set as its hydration, iterated records are parsed into models on a pool of workers.  With a
+    SlowQueryLog set as its slow_query_log, the QueryStats of gets, counts and iterations slower than its threshold are
+    kept, and with a rest_client.MetricsRegistry set as its metrics, queries, their requests and the parsing of models are
+    reported to it."""
     def __init__(self, model, finders):
         self.model = model
         self.finders = {}
         self.headers = {}
+        self.client = rest_client.Client("")
+        self.async_client = rest_client.AsyncClient("")
+        self.coalescing = None
+        self.limiter = rest_client.default_limiter
+        self.count_header = None
+        self.head_count = False
+        self.pagination = None
+        self.prefetch = 0
+        self.instance_cache = None
+        self.record_path = None
+        self.hydration = None
+        self.slow_query_log = None
+        self.metrics = None
         for key in finders.keys():
             field_names = [field if isinstance(field, str) else field._name for field in key]
             sorted_field_names = list(field_names)
@@ -29,84 +54,1164 @@ class ModelManager(object):
     def get(self, **kw):
         return ModelQuery(self, self.model, headers=self.headers).get(**kw)
 
+    def aget(self, **kw):
+        return ModelQuery(self, self.model, headers=self.headers).aget(**kw)
+
+    def invalidate(self, **kw):
+        """Drops the model got with the finder args kw, or every model of this type when there are none, from
+        the instance cache entered on this thread and the manager's own"""
+        key = None
+        if kw:
+            key = ModelQuery(self, self.model, headers=self.headers).filter(**kw)._instance_key()
+        for cache in _scoped_caches() + [self.instance_cache]:
+            if cache is not None:
+                cache.invalidate(self.model, key)
+
+    def _instance_cache(self):
+        scoped = _scoped_caches()
+        if scoped:
+            return scoped[-1]
+        return self.instance_cache
+
+    def get_many(self, lookups, max_concurrency=10):
+        """Gets a model for each dict of finder args in lookups, e.g. [{'id': 1}, {'id': 2}], with up to
+        max_concurrency requests in flight at once, and no more than the manager's limiter allows for
+        each host.  Results are in the order of lookups, with the DoesNotExist error in place of any
+        model that was not found."""
+        queries = [ModelQuery(self, self.model, headers=self.headers).filter(**kw) for kw in lookups]
+        for query in queries:
+            query._find_query_path()
+        cache = self._instance_cache()
+        def fetch(query):
+            try:
+                return query._get_using(cache, limited=True)
+            except DoesNotExist, e:
+                return e
+        return _concurrent_map(fetch, queries, max_concurrency)
+
 
 class ModelQuery(object):
+    """The results of a query are fetched once, the first time they are needed, and kept for len(), bool(),
+    indexing and further iteration.  Use iterator() to stream through the results without keeping them.
+    When the manager has a pagination, iteration and bool() fetch pages only as they reach them, keeping the
+    results read so far, and indexing or slicing, e.g. query[1000:1050], fetches only the pages holding the
+    results asked for."""
 
     def __init__(self, manager, model, headers={}):
         self.manager = manager
         self.model = model
         self.args = {}
         self.headers = headers
+        self._result_cache = None
+        self._result_iter = None
+        self._stats = None
         if 'xml_models' in str(model.__class__):
             self._fragments = self._xml_fragments
+            self._raw_fragments = self._raw_xml_fragments
+            self._model_for = lambda dom: model(dom=dom)
         elif 'json_models' in str(model.__class__):
             self._fragments = self._json_fragments
+            self._raw_fragments = self._json_fragments
+            self._model_for = model
         else:
             raise NonSupportedModelError
 
     def filter(self, **kw):
         for key in kw.keys():
             self.args[key] = kw[key]
+        self._result_cache = self._result_iter = None
         return self
 
     def filter_custom(self, url):
         self.custom_url = url
+        self._result_cache = self._result_iter = None
         return self
 
     def count(self):
-        response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
-        count = 0
-        for x in self._fragments(response.content):
-            count += 1
-        return count
+        if self._all_read():
+            return len(self._result_cache)
+        fetch = self._fetch_count
+        if self.manager.coalescing is None:
+            return fetch()
+        return self.manager.coalescing.call(('count',) + self._coalescing_key(), fetch, lambda count: count)
+
+    def exists(self):
+        "True if the query matches anything, reading no further than the first result"
+        if self._result_cache or self._all_read():
+            return bool(self._result_cache)
+        if self.manager.count_header and self.manager.head_count:
+            count = self._head_count()
+            if count is not None:
+                return count > 0
+        response = self.manager.client.GET(self._page_path(), headers=self.headers)
+        try:
+            if response.response_code == 404:
+                return False
+            for fragment in self._fragments(response.content):
+                return True
+            return False
+        finally:
+            _discard(response)
+
+    def acount(self):
+        "As count, but returns a Pending count from the manager's AsyncClient, reading through the pages when paged"
+        if self.manager.pagination is None:
+            return self.manager.async_client.GET(self._find_query_path(), headers=self.headers).then(self._count)
+        counted = []
+        def read(response):
+            if self.manager.count_header:
+                count = self._header_count(response)
+                if count is not None:
+                    _discard(response)
+                    counted.append(count)
+                    return count, None
+            count = self._count(response)
+            return count, count
+        def total(counts):
+            if counted:
+                return counted[0]
+            return sum(counts)
+        return self._apages(read).then(total)
+
+    def explain(self):
+        "The QueryStats of this query before it is run, giving the url it resolves to and the finder that url came from"
+        return QueryStats(self.model, self._find_query_path(), self._find_finder())
+
+    def execute_with_stats(self):
+        "Runs the query, keeping its results as iteration would, and returns them with the QueryStats of running it"
+        self._stats = stats = self.explain()
+        self._result_cache, self._result_iter = list(self.iterator()), None
+        return self._result_cache, stats
+
+    def iterator(self, prefetch=None):
+        """Streams through the results in one pass, without keeping them.  When paged, up to prefetch pages, by default
+        the manager's prefetch, are read ahead in the background while the results of the current page are used."""
+        metrics = self.manager.metrics
+        if self._stats is None and (self.manager.slow_query_log is not None or metrics is not None):
+            self._stats = self.explain()
+        stats, self._stats = self._stats, None
+        models = self._models(prefetch, stats)
+        if stats is None:
+            for model in models:
+                yield model
+            return
+        stats.start()
+        try:
+            for model in stats.timed('build', models):
+                stats.records += 1
+                yield model
+        except Exception:
+            if metrics is not None:
+                metrics.observe_query_error(stats)
+            raise
+        finally:
+            self._stats = None
+            stats.finish()
+            if self.manager.slow_query_log is not None:
+                self.manager.slow_query_log.observe(stats)
+            if metrics is not None:
+                metrics.observe_query(stats)
+
+    def _models(self, prefetch, stats):
+        if prefetch is None:
+            prefetch = self.manager.prefetch
+        hydration = self.manager.hydration
+        split = hydration is None and self._fragments or self._raw_fragments
+        self._stats = stats
+        if self.manager.pagination is not None:
+            fragments = prefetch and self._prefetched_fragments(0, prefetch, split) or self._paged_fragments(0, split)
+        else:
+            fragments = self._response_fragments(self._find_query_path(), split)
+        if stats is not None:
+            fragments = stats.timed('split', fragments)
+        if hydration is None:
+            return itertools.imap(self._model_for, fragments)
+        return hydration.map(self.model, fragments)
+
+    def _response_fragments(self, url, split):
+        "Yields the records split from the body of url, only GETting it once the first is wanted"
+        response = self._get(url)
+        try:
+            for fragment in split(response.content):
+                yield fragment
+        finally:
+            _discard(response)
+
+    def _get(self, url, method='GET'):
+        "GETs url, or makes another request without a body, measuring it in the QueryStats of the query it is for, if any"
+        request = lambda: getattr(self.manager.client, method)(url, headers=self.headers)
+        if self._stats is None:
+            return request()
+        return self._stats.measure(request)
 
     def __iter__(self):
-        response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
-        for fragment in self._fragments(response.content):
-            yield self.model(fragment)
+        index = 0
+        while True:
+            self._fill(index + 1)
+            if index >= len(self._result_cache):
+                return
+            yield self._result_cache[index]
+            index += 1
+
+    def alist(self):
+        "Returns a Pending list of the models matched, fetched with the manager's AsyncClient, a page at a time when paged"
+        def models(response):
+            return [self._model_for(fragment) for fragment in self._fragments(response.content)]
+        def keep(models):
+            self._result_cache, self._result_iter = models, None
+            return models
+        if self.manager.pagination is None:
+            return self.manager.async_client.GET(self._find_query_path(), headers=self.headers).then(models).then(keep)
+        def read(response):
+            page = models(response)
+            return page, len(page)
+        return self._apages(read).then(lambda pages: keep(list(itertools.chain.from_iterable(pages))))
+
+    def _apages(self, read):
+        """A Pending list of read(response) for each page of results, fetched one after another with the manager's
+        AsyncClient.  read returns its value for the page and the number of records on it, or None for that to stop."""
+        pagination = self.manager.pagination
+        base_url = self._find_query_path()
+        client = self.manager.async_client
+        pages = rest_client.Pending(client.loop)
+        values = []
+        def fetch(url, first):
+            client.GET(url, headers=self.headers).add_callback(lambda pending: fetched(url, first, pending))
+        def fetched(url, first, pending):
+            try:
+                response = pending.result()
+                if response.response_code == 404:
+                    _discard(response)
+                    return pages.set_result(values)
+                value, records = read(response)
+                following = records is not None and pagination.following(base_url, url, response, first, records) or None
+            except:
+                return pages.set_exception(sys.exc_info())
+            values.append(value)
+            if following is None:
+                return pages.set_result(values)
+            fetch(following, first + records)
+        fetch(pagination.locate(base_url, 0)[0], 0)
+        return pages
 
     def __len__(self):
-        return self.count()
+        self._fill()
+        return len(self._result_cache)
+
+    def __nonzero__(self):
+        self._fill(1)
+        return bool(self._result_cache)
+
+    def __getitem__(self, index):
+        if not self._all_read() and self.manager.pagination is not None:
+            read = self._result_cache or []
+            if isinstance(index, int) and 0 <= index < len(read):
+                return read[index]
+            if isinstance(index, slice) and (index.start or 0) >= 0 and index.stop is not None and 0 <= index.stop <= len(read):
+                return read[index]
+            if isinstance(index, slice) and (index.start or 0) >= 0 and index.stop is not None and index.stop >= 0:
+                start = index.start or 0
+                wanted = len(xrange(start, index.stop, index.step or 1))
+                if not wanted:
+                    return []
+                last = (index.step or 1) * (wanted - 1)
+                fragments = itertools.islice(self._paged_fragments(start), 0, last + 1, index.step)
+                return [self._model_for(fragment) for fragment in fragments]
+            if isinstance(index, int) and index >= 0:
+                for fragment in self._paged_fragments(index):
+                    return self._model_for(fragment)
+                raise IndexError(index)
+        self._fill()
+        return self._result_cache[index]
+
+    def _fill(self, wanted=None):
+        """Reads results into the result cache until it holds wanted of them, or all of them if wanted is None.
+        Unless paged, all are read at once, so no response is left part read."""
+        if self._result_cache is None:
+            self._result_cache, self._result_iter = [], self.iterator()
+        if self.manager.pagination is None:
+            wanted = None
+        while self._result_iter is not None and (wanted is None or len(self._result_cache) < wanted):
+            try:
+                self._result_cache.append(next(self._result_iter))
+            except StopIteration:
+                self._result_iter = None
+            except:
+                self._result_cache = self._result_iter = None
+                raise
+
+    def _all_read(self):
+        return self._result_cache is not None and self._result_iter is None
 
     def get(self, **kw):
         for key in kw.keys():
             self.args[key] = kw[key]
-        response = rest_client.Client("").GET(self._find_query_path(), headers=self.headers)
-        if not response.content:
-            raise DoesNotExist(self.model, self.args)
-        if response.response_code == 404:
+        return self._get_using(self.manager._instance_cache())
+
+    def _get_using(self, cache, limited=False):
+        """Gets the single result through cache, an InstanceCache or None, which is looked up on the calling thread.
+        If limited, only a request actually made, not a cache hit or a wait on a coalesced request, waits on the
+        manager's limiter."""
+        fetch = self._fetch_single
+        if limited:
+            fetch = lambda: self._limited(self._fetch_single)
+        if cache is not None:
+            return self._cached_get(cache, fetch)
+        return self._coalesced_get(lambda: fetch()[0])
+
+    def _fetch_single(self):
+        "GETs the single result, returning the model and the bytes read for it"
+        def fetch(stats):
+            request = lambda: self.manager.client.GET(self._find_query_path(), headers=self.headers)
+            if stats is None:
+                response = request()
+                return self._single_result(response), getattr(response.content, 'bytes_read', 0)
+            model = self._single_result(stats.measure(request))
+            stats.records = 1
+            return model, stats.bytes
+        return self._observed(fetch)
+
+    def _observed(self, run):
+        """Returns run(stats), with the QueryStats of running it when the manager has a slow_query_log or metrics,
+        else None, and reports the stats into them"""
+        metrics = self.manager.metrics
+        slow_query_log = self.manager.slow_query_log
+        if metrics is None and slow_query_log is None:
+            return run(None)
+        stats = self.explain()
+        stats.start()
+        try:
+            return run(stats)
+        except DoesNotExist:
+            raise
+        except Exception:
+            if metrics is not None:
+                metrics.observe_query_error(stats)
+            raise
+        finally:
+            stats.finish()
+            if slow_query_log is not None:
+                slow_query_log.observe(stats)
+            if metrics is not None:
+                metrics.observe_query(stats)
+
+    def _coalesced_get(self, fetch):
+        if self.manager.coalescing is None:
+            return fetch()
+        return self.manager.coalescing.call(('get',) + self._coalescing_key(), fetch, lambda model: model._clone())
+
+    def aget(self, **kw):
+        "As get, but returns a Pending model from the manager's AsyncClient"
+        for key in kw.keys():
+            self.args[key] = kw[key]
+        return self.manager.async_client.GET(self._find_query_path(), headers=self.headers).then(self._single_result)
+
+    def _cached_get(self, cache, fetch_single):
+        key = self._instance_key()
+        entry = cache.lookup(key)
+        if entry is None:
+            def fetch():
+                try:
+                    model, size = fetch_single()
+                except DoesNotExist:
+                    cache.store_missing(key)
+                    raise
+                return cache.store(key, model, size).model
+            model = self._coalesced_get(fetch)
+        elif entry.model is None:
             raise DoesNotExist(self.model, self.args)
-        content = response.content.read()
-        if not content:
+        else:
+            model = entry.model
+        if cache.share_instances:
+            return model
+        return model._clone()
+
+    def _limited(self, fetch):
+        "Calls fetch once the manager's limiter lets a request through to the finder's host"
+        limiter = self.manager.limiter
+        if limiter is None:
+            return fetch()
+        host = urlparse.urlsplit(self._find_query_path()).netloc
+        limiter.acquire(host)
+        started = time.time()
+        failed = True
+        try:
+            result = fetch()
+            failed = False
+            return result
+        except DoesNotExist:
+            failed = False
+            raise
+        finally:
+            limiter.release(host, time.time() - started, failed)
+
+    def _coalescing_key(self):
+        return (self._find_query_path(), tuple(sorted(self.headers.items())))
+
+    def _instance_key(self):
+        "The model, url and headers an InstanceCache keeps the result of a get under, so custom urls are told apart"
+        return (self.model,) + self._coalescing_key()
+
+    def _fetch_count(self):
+        def fetch(stats):
+            self._stats = stats
+            try:
+                if self.manager.count_header and self.manager.head_count:
+                    count = self._head_count()
+                    if count is not None:
+                        return count
+                if self.manager.pagination is not None:
+                    return self._paged_count()
+                return self._count(self._get(self._find_query_path()))
+            finally:
+                self._stats = None
+        return self._observed(fetch)
+
+    def _page_path(self, index=0):
+        "The url of the page holding the index'th result, which is the finder's url unless the manager has a pagination"
+        if self.manager.pagination is None:
+            return self._find_query_path()
+        return self.manager.pagination.locate(self._find_query_path(), index)[0]
+
+    def _paged_fragments(self, index, split=None):
+        "Yields the records from the index'th on, fetching each page as it is reached"
+        return itertools.chain.from_iterable(self._pages(index, split))
+
+    def _pages(self, index, split=None, limited=False):
+        """Yields the records of each page, from the page holding the index'th result, as an iterator.  Each
+        must be read through before the next page is fetched.  If limited, each page is fetched and read
+        into a list within the manager's limiter."""
+        pagination = self.manager.pagination
+        base_url = self._find_query_path()
+        url, skip = pagination.locate(base_url, index)
+        first = index - skip
+        while url is not None:
+            read = [0]
+            def fetch():
+                response = self._get(url)
+                if response.response_code == 404:
+                    _discard(response)
+                    return response, None
+                page = self._page_fragments((split or self._fragments)(response.content), skip, read)
+                if limited:
+                    page = list(page)
+                return response, page
+            if limited:
+                response, page = self._limited(fetch)
+            else:
+                response, page = fetch()
+            if page is None:
+                return
+            try:
+                yield page
+            finally:
+                _discard(response)
+            url = pagination.following(base_url, url, response, first, read[0])
+            first += read[0]
+            skip = max(skip - read[0], 0)
+
+    def _page_fragments(self, fragments, skip, read):
+        for fragment in fragments:
+            read[0] += 1
+            if read[0] > skip:
+                yield fragment
+
+    def _prefetched_fragments(self, index, depth, split=None):
+        """As _paged_fragments, but up to depth pages beyond the one being read are fetched and split into records
+        on a background thread, each within the manager's limiter.  The thread stops once the records are read,
+        or when they are no longer wanted."""
+        pages = Queue.Queue(depth)
+        stopped = threading.Event()
+        def put(item):
+            while not stopped.isSet():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def read_ahead():
+            try:
+                for page in self._pages(index, split, limited=True):
+                    if not put((page, None)):
+                        return
+            except:
+                put((None, sys.exc_info()))
+                return
+            put((None, None))
+        thread = threading.Thread(target=read_ahead)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            while True:
+                page, exc_info = pages.get()
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if page is None:
+                    return
+                for fragment in page:
+                    yield fragment
+        finally:
+            stopped.set()
+
+    def _paged_count(self):
+        pagination = self.manager.pagination
+        base_url = self._find_query_path()
+        url = pagination.locate(base_url, 0)[0]
+        total = 0
+        while url is not None:
+            response = self._get(url)
+            if response.response_code == 404:
+                _discard(response)
+                break
+            if self.manager.count_header and self._header_count(response) is not None:
+                return self._count(response)
+            records = self._count(response)
+            url = pagination.following(base_url, url, response, total, records)
+            total += records
+        return total
+
+    def _head_count(self):
+        "The count from the count_header of a HEAD request, or None if the service does not give one"
+        response = self._get(self._find_query_path(), 'HEAD')
+        try:
+            return self._header_count(response)
+        finally:
+            _discard(response)
+
+    def _header_count(self, response):
+        "The count from the manager's count_header, or None if the response does not carry one"
+        value = getattr(response, 'headers', {}).get(self.manager.count_header.lower())
+        if value is None or response.response_code >= 400:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return None
+
+    def _count(self, response):
+        try:
+            if self.manager.count_header:
+                count = self._header_count(response)
+                if count is not None:
+                    return count
+            if self._fragments == self._xml_fragments:
+                return self.model._count_records(rest_client.ResponseStream.wrap(response.content), self.manager.record_path)
+            count = 0
+            for x in self._fragments(response.content):
+                count += 1
+            return count
+        finally:
+            _discard(response)
+
+    def _single_result(self, response):
+        if not response.content:
             raise DoesNotExist(self.model, self.args)
-        return self.model(content)
+        content = rest_client.ResponseStream.wrap(response.content)
+        try:
+            if response.response_code == 404 or content.is_empty():
+                raise DoesNotExist(self.model, self.args)
+            return self.model.from_stream(content)
+        finally:
+            content.discard()
 
     def _xml_fragments(self, xml):
-        tree = et.iterparse(xml, ['start','end'])
-        tree.next()
-        evt, child = tree.next()
-        node_name = child.tag
-        for event, elem in tree:
-            if event == 'end' and elem.tag == node_name:
-                result = et.tostring(elem)
-                elem.clear()
-                yield result
+        "Yields the already parsed document of each record, for the model to be built on without parsing it again"
+        return self.model._records(rest_client.ResponseStream.wrap(xml), self.manager.record_path)
+
+    def _raw_xml_fragments(self, xml):
+        "Yields the text of each record, to be parsed elsewhere"
+        return self.model._raw_records(rest_client.ResponseStream.wrap(xml), self.manager.record_path)
 
     def _json_fragments(self, json):
-        for result in json.readlines():
-            yield result
+        """Yields each record of a json body, read from the manager's record_path, e.g. 'results.*', a top level
+        array, or else one record per line"""
+        content = rest_client.ResponseStream.wrap(json)
+        path = self.manager.record_path
+        if path is None and content.peek().lstrip()[:1] == '[':
+            path = '*'
+        if path is not None:
+            for record in _json_records(content, path.split('.')):
+                yield record
+            return
+        for line in content:
+            if line.strip():
+                yield line
 
     def _find_query_path(self):
         if hasattr(self, 'custom_url'):
             return self.custom_url
+        (url, attrs) = self.manager.finders[self._find_finder()]
+        return url % tuple([ self.args[x] for x in attrs])
+
+    def _find_finder(self):
+        "The sorted field names of the finder the query's args resolve to, or None for a custom url"
+        if hasattr(self, 'custom_url'):
+            return None
         keys = self.args.keys()
         keys.sort()
         key_tuple = tuple(keys)
-        try:
-            (url, attrs) = self.manager.finders[key_tuple]
-            return url % tuple([ self.args[x] for x in attrs])
-        except KeyError:
+        if key_tuple not in self.manager.finders:
             raise NoRegisteredFinderError(str(key_tuple))
+        return key_tuple
+
+class QueryStats(object):
+    """
+    What running a query took: the url it resolved to, and the finder's field names, or None for a custom url,
+    then the requests made, bytes read and records found, and the seconds spent on http, waiting for and
+    reading responses, on splitting the responses into records and on building models from them.  Each phase
+    is timed exclusive of the others, and of the caller's own work between records.  Work done on other
+    threads, by read ahead or parallel hydration, is counted too, so the phases can add up to more than
+    total_time, the time from the first record being asked for to the last.
+    """
+    def __init__(self, model, url, finder):
+        self.model = model
+        self.url = url
+        self.finder = finder
+        self.requests = 0
+        self.bytes = 0
+        self.records = 0
+        self.http_time = 0.0
+        self.split_time = 0.0
+        self.build_time = 0.0
+        self.total_time = None
+        self._started = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self):
+        self._started = monotonic()
+
+    def finish(self):
+        self.total_time = monotonic() - self._started
+
+    def timed(self, phase, iterable):
+        "Yields from iterable, counting the time spent getting each item to phase"
+        iterator = iter(iterable)
+        while True:
+            self._enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._leave()
+            yield item
+
+    def measure(self, request):
+        "Makes a request, counting it, the time it takes and the time and bytes of reading its body"
+        self._enter('http')
+        try:
+            response = request()
+        finally:
+            self._leave()
+        self._add('requests', 1)
+        return _MeasuredResponse(response, self)
+
+    def _enter(self, phase):
+        now = monotonic()
+        stack = self._stack()
+        if stack:
+            self._add(stack[-1][0] + '_time', now - stack[-1][1])
+        stack.append([phase, now])
+
+    def _leave(self):
+        now = monotonic()
+        stack = self._stack()
+        phase, since = stack.pop()
+        self._add(phase + '_time', now - since)
+        if stack:
+            stack[-1][1] = now
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add(self, counter, amount):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + amount)
+        finally:
+            self._lock.release()
+
+    def __str__(self):
+        query = "%s %s (finder %s)" % (self.model.__name__, self.url, self.finder and ', '.join(self.finder) or 'custom url')
+        if self.total_time is None:
+            return query + ", not run"
+        return "%s: %d requests, %d bytes, %d records in %.3fs; http %.3fs, split %.3fs, build %.3fs" % (
+            query, self.requests, self.bytes, self.records, self.total_time, self.http_time, self.split_time, self.build_time)
+
+# Model class attributes copied onto the model's manager, and onto the manager's client, with the names they take there
+_manager_attributes = [('headers', 'headers'), ('coalescing', 'coalescing'), ('count_header', 'count_header'),
+                       ('head_count', 'head_count'), ('pagination', 'pagination'), ('prefetch', 'prefetch'),
+                       ('instance_cache', 'instance_cache'), ('record_path', 'record_path'), ('hydration', 'hydration'),
+                       ('slow_query_log', 'slow_query_log'), ('metrics', 'metrics')]
+_client_attributes = [('response_cache', 'cache'), ('decompress', 'decompress'), ('hedging', 'hedging'),
+                      ('spool_threshold', 'spool_threshold'), ('metrics', 'metrics')]
+
+def _configure_manager(manager, attrs):
+    "Applies the settings declared in a model's class attrs to its manager and the manager's client"
+    for attribute, name in _manager_attributes:
+        if attrs.has_key(attribute):
+            setattr(manager, name, attrs[attribute])
+    for attribute, name in _client_attributes:
+        if attrs.has_key(attribute):
+            setattr(manager.client, name, attrs[attribute])
+
+def _discard(response):
+    "Drops what is left of a response body, so its connection can go back to the pool"
+    content = getattr(response, 'content', None)
+    if content is not None:
+        rest_client.ResponseStream.wrap(content).discard()
+
+def _timed_parse(model, parse, source):
+    "Returns parse(source), reporting the time taken into the metrics of model's manager, if any"
+    metrics = getattr(model.objects, 'metrics', None)
+    if metrics is None:
+        return parse(source)
+    started = monotonic()
+    try:
+        return parse(source)
+    finally:
+        metrics.parse_seconds.observe((model.__name__,), monotonic() - started)
+
+def _timed_records(model, records):
+    "Yields each of the parsed records, reporting the time taken to parse each into the metrics of model's manager"
+    metrics = model.objects.metrics
+    records = iter(records)
+    while True:
+        started = monotonic()
+        try:
+            record = next(records)
+        except StopIteration:
+            return
+        metrics.parse_seconds.observe((model.__name__,), monotonic() - started)
+        yield record
+
+class _MeasuredResponse(object):
+    def __init__(self, response, stats):
+        self.response_code = getattr(response, 'response_code', 200)
+        self.headers = getattr(response, 'headers', {})
+        self.content = _MeasuredBody(rest_client.ResponseStream.wrap(response.content), stats)
+
+class _MeasuredBody(object):
+    def __init__(self, body, stats):
+        self._body = body
+        self._stats = stats
+
+    def read(self, amt=None):
+        return self._measured(self._body.read, amt)
+
+    def readline(self):
+        return self._measured(self._body.readline)
+
+    def close(self):
+        self._body.close()
+
+    def _measured(self, read, *args):
+        self._stats._enter('http')
+        try:
+            data = read(*args)
+        finally:
+            self._stats._leave()
+        self._stats._add('bytes', len(data))
+        return data
+
+class SlowQueryLog(object):
+    """
+    Set as the slow_query_log of a model, keeps the QueryStats of the last max_entries gets, counts and
+    iterations of its queries that took threshold seconds or more, each naming the model queried, and passes each to
+    callback, when one is given.
+    """
+    def __init__(self, threshold=1.0, max_entries=100, callback=None):
+        self.threshold = threshold
+        self.callback = callback
+        self.entries = deque(maxlen=max_entries)
+
+    def observe(self, stats):
+        if stats.total_time < self.threshold:
+            return
+        self.entries.append(stats)
+        if self.callback is not None:
+            self.callback(stats)
+
+class Coalescing(object):
+    """
+    Set as the coalescing attribute of a model, concurrent identical gets and counts share one request
+    and parse.  Every caller gets a model of its own, copied from the one parsed, unless
+    share_instances is True, in which case they all get the same model, made immutable.  fetches
+    counts the requests made and coalesced the callers that waited on another's request instead.
+    """
+    def __init__(self, share_instances=False):
+        self.share_instances = share_instances
+        self.fetches = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, fetch, copy):
+        self._lock.acquire()
+        try:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+                self.fetches += 1
+            else:
+                self.coalesced += 1
+        finally:
+            self._lock.release()
+        if not leader:
+            return self._follow(flight, copy)
+        try:
+            flight.result = fetch()
+            if self.share_instances and hasattr(flight.result, '_immutable'):
+                flight.result._immutable = True
+        except:
+            flight.exc_info = sys.exc_info()
+        self._lock.acquire()
+        try:
+            del self._in_flight[key]
+        finally:
+            self._lock.release()
+        flight.event.set()
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.result
+
+    def _follow(self, flight, copy):
+        flight.event.wait()
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        if self.share_instances:
+            return flight.result
+        return copy(flight.result)
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class InstanceCache(object):
+    """
+    Keeps the model got for each finder and its args for ttl seconds, evicting the least recently used once
+    there are more than max_entries, or once the responses they were read from total more than max_bytes.
+    A DoesNotExist is remembered too, for negative_ttl seconds, which defaults to ttl.  Set it as the
+    instance_cache of a model to share it across the process, or enter it in a with statement to use it
+    for the gets of every model on the current thread until the block ends, e.g. for one web request.
+    Callers get a copy of the cached model, unless share_instances is True, in which case they all get
+    the same model, made immutable.  hits and misses count the gets served from the cache and not.
+    """
+    def __init__(self, ttl=60, max_entries=1000, max_bytes=None, negative_ttl=None, share_instances=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl is None and ttl or negative_ttl
+        self.share_instances = share_instances
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _scoped_caches().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _scoped_caches().pop()
+
+    def lookup(self, key):
+        "The unexpired _CachedInstance for key, or None.  Its model is None when the get raised DoesNotExist."
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.expires > time.time():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.size -= entry.size
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def store(self, key, model, size=0):
+        if self.share_instances:
+            model._immutable = True
+        return self._add(key, _CachedInstance(model, size, time.time() + self.ttl))
+
+    def store_missing(self, key):
+        if self.negative_ttl:
+            self._add(key, _CachedInstance(None, 0, time.time() + self.negative_ttl))
+
+    def invalidate(self, model, key=None):
+        "Drops the entry kept under key, or every entry for model when there is none"
+        self._lock.acquire()
+        try:
+            if key is not None:
+                self._remove(key)
+            else:
+                for key in [key for key in self._entries if key[0] is model]:
+                    self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries, self.size = OrderedDict(), 0
+        finally:
+            self._lock.release()
+
+    def _add(self, key, entry):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+        finally:
+            self._lock.release()
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+class _CachedInstance(object):
+    def __init__(self, model, size, expires):
+        self.model = model
+        self.size = size
+        self.expires = expires
+
+_scoped = threading.local()
+
+def _scoped_caches():
+    "The InstanceCaches entered on the current thread, innermost last"
+    if not hasattr(_scoped, 'caches'):
+        _scoped.caches = []
+    return _scoped.caches
+
+class ParallelHydration(object):
+    """
+    Set as the hydration attribute of a model, the records read while iterating a query are split out
+    unparsed and handed to a pool of workers batch_size at a time, with no more than max_in_flight
+    batches outstanding, and the models are yielded in order.  With the 'thread' backend, each worker
+    parses its records into models, which scales with lxml as it releases the GIL while parsing.  With
+    the 'process' backend, workers return just the values of the fields, other than collections and
+    nested models, for xml, or the decoded data for json, and the models are built on those.  Models
+    used with the process backend must be importable by the workers, i.e. defined at module level.
+    """
+    def __init__(self, backend='thread', workers=None, batch_size=100, max_in_flight=None):
+        if backend not in ('thread', 'process'):
+            raise ValueError("backend must be 'thread' or 'process', not %r" % backend)
+        self.backend = backend
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def map(self, model, fragments):
+        "Yields a model for each of the raw records in fragments, in order"
+        pool = self._get_pool()
+        in_flight = deque()
+        fragments = iter(fragments)
+        batches = iter(lambda: list(itertools.islice(fragments, self.batch_size)), [])
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                work = self.backend == 'thread' and _hydrate_batch or _field_values_batch
+                in_flight.append((batch, pool.apply_async(work, (model, batch))))
+            while in_flight and (batch is None or len(in_flight) >= self.max_in_flight):
+                raws, result = in_flight.popleft()
+                if self.backend == 'thread':
+                    models = result.get()
+                else:
+                    models = [model._from_field_values(raw, values) for raw, values in zip(raws, result.get())]
+                for hydrated in models:
+                    yield hydrated
+
+    def close(self):
+        "Stops the workers, which are started again if needed"
+        self._lock.acquire()
+        try:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+        finally:
+            self._lock.release()
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = self.backend == 'thread' and ThreadPool(self.workers) or multiprocessing.Pool(self.workers)
+            return self._pool
+        finally:
+            self._lock.release()
+
+def _hydrate_batch(model, raws):
+    return [model._hydrate(raw) for raw in raws]
+
+def _field_values_batch(model, raws):
+    return [model._field_values(raw) for raw in raws]
+
+class Pagination(object):
+    """
+    Describes how a service pages the results of a finder.  locate gives the url of the page holding a
+    result, and how many records on that page come before it, and following gives the url of the page
+    after one that has been read, or None once there are no more.
+    """
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+
+    def locate(self, url, index):
+        raise NotImplementedError
+
+    def following(self, url, page_url, response, first, records):
+        if records < self.page_size:
+            return None
+        return self.locate(url, first + records)[0]
+
+    def _with_params(self, url, params):
+        return url + ('?' in url and '&' or '?') + urllib.urlencode(params)
+
+class OffsetPagination(Pagination):
+    "Pages with offset and limit parameters, e.g. ?offset=1000&limit=50"
+    def __init__(self, page_size=100, offset_param='offset', limit_param='limit'):
+        Pagination.__init__(self, page_size)
+        self.offset_param = offset_param
+        self.limit_param = limit_param
+
+    def locate(self, url, index):
+        return self._with_params(url, [(self.offset_param, index), (self.limit_param, self.page_size)]), 0
+
+class PagePagination(Pagination):
+    "Pages with page number and size parameters, e.g. ?page=21&size=50, counting pages from first_page"
+    def __init__(self, page_size=100, page_param='page', size_param='size', first_page=1):
+        Pagination.__init__(self, page_size)
+        self.page_param = page_param
+        self.size_param = size_param
+        self.first_page = first_page
+
+    def locate(self, url, index):
+        page, skip = divmod(index, self.page_size)
+        return self._with_params(url, [(self.page_param, page + self.first_page), (self.size_param, self.page_size)]), skip
+
+class CursorPagination(Pagination):
+    """Follows the link to the next page given in the next_header of each response, either a Link header
+    with rel="next" or a header holding just the url.  As a cursor cannot be jumped to, reaching a result
+    means reading through the pages before it."""
+    def __init__(self, next_header='Link'):
+        Pagination.__init__(self, None)
+        self.next_header = next_header
+
+    def locate(self, url, index):
+        return url, index
+
+    def following(self, url, page_url, response, first, records):
+        value = getattr(response, 'headers', {}).get(self.next_header.lower())
+        if not value:
+            return None
+        if self.next_header.lower() == 'link':
+            value = _next_link(value)
+        return value and urlparse.urljoin(page_url, value) or None
+
+def _next_link(header):
+    "The url of the rel=\"next\" entry of a Link header, or None"
+    for link in header.split(','):
+        parts = link.split(';')
+        params = [param.strip().replace('"', '') for param in parts[1:]]
+        if 'rel=next' in params:
+            return parts[0].strip().strip('<>')
+    return None
+
+_json_structure = re.compile(r'["\[\]{}:,]')
+_json_string_end = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+
+def _json_records(stream, path, chunk_size=16384):
+    """Yields the text of each value at path in a json document, a list of keys with '*' standing for the items
+    of an array.  The document is read a chunk at a time, holding no more of it than the value being read."""
+    buffer = ''
+    pos = 0
+    stack = []
+    expect_key = False
+    capture = None
+    capture_depth = None
+    while True:
+        match = _json_structure.search(buffer, pos)
+        string_end = match and match.group() == '"' and _json_string_end.match(buffer, match.end())
+        if match is None or match.group() == '"' and not string_end:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            rescan_from = len(buffer)
+            if match is not None:
+                rescan_from = match.start()
+            keep_from = rescan_from
+            if capture is not None:
+                keep_from, capture = capture, 0
+            buffer, pos = buffer[keep_from:] + chunk, rescan_from - keep_from
+            continue
+        token, pos = match.group(), match.end()
+        if token == '"':
+            pos = string_end.end()
+            if expect_key and capture is None:
+                stack[-1][1] = json.loads(buffer[match.start():pos])
+            expect_key = False
+            continue
+        value_starts = token == ':'
+        if token in '{[':
+            stack.append([token == '{', token == '[' and '*' or None])
+            expect_key = token == '{'
+            value_starts = token == '['
+        elif token in ']},':
+            if capture is not None and len(stack) == capture_depth:
+                record = buffer[capture:match.start()].strip()
+                if record:
+                    yield record
+                capture = None
+            if token == ',':
+                expect_key = stack and stack[-1][0]
+                value_starts = not expect_key
+            else:
+                stack.pop()
+                expect_key = False
+        if value_starts and capture is None and [key for is_object, key in stack] == path:
+            capture, capture_depth = pos, len(stack)
+
+def _concurrent_map(func, items, max_concurrency):
+    "Applies func to each item on up to max_concurrency threads, returning the results in order"
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+    def worker():
+        while not errors:
+            try:
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=worker) for i in range(min(max_concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
 
 class NoRegisteredFinderError(Exception):
     pass
@@ -117,6 +1222,9 @@ class NonSupportedModelError(Exception):
 class ValidationError(Exception):
     pass
 
+class ImmutableModelError(Exception):
+    pass
+
 class DoesNotExist(Exception):
 
     def __init__(self, model, args):
@@ -36,6 +36,15 @@ class ModelStubManager(object):
                 return exp.called()
         raise DoesNotExist(self.model, kw)
 
+    def get_many(self, lookups, max_concurrency=10):
+        results = []
+        for kw in lookups:
+            try:
+                results.append(self.get(**kw))
+            except DoesNotExist, e:
+                results.append(e)
+        return results
+
 XmlModelStubManager = ModelStubManager
 
 class Expectation(object):
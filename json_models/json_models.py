@@ -29,6 +29,7 @@ or implied, of the FreeBSD Project.
 import json, time
 from datetime import datetime
 from common_models import *
+from common_models.common_models import _timed_parse, _configure_manager
 
 
 class BaseField:
@@ -37,34 +38,33 @@ class BaseField:
             raise Exception('No Path supplied for json field')
         self.path = kw['path']
         self._default = kw.pop('default', None)
+        self._get = _compiled_getter(self.path, self._default)
+        self._set = _compiled_setter(self.path)
 
     def get_nested_value(self, data, nodes):
-        node = nodes.pop(0)
-        if len(nodes) > 0:
-            find = self.get_nested_value(getattr(data, node),nodes)
-        else:
-            find = getattr(data, node)
-        if ((find == None) or (find == {})):
-            return self._default
-        else:
-            return find
+        return _compiled_getter('.'.join(nodes), self._default)(_plain(data))
 
     def _parse(self, json_data):
-        nodes = self.path.split('.')
-        return self.get_nested_value(json_data, nodes)
+        return self._get(_plain(json_data))
 
     def save(self,value):
         return value
 
 class CharField(BaseField):
+    _as_stored = True
+
     def parse(self, json_data):
         return self._parse(json_data)
 
 class IntField(BaseField):
+    _as_stored = True
+
     def parse(self, json_data):
         return self._parse(json_data)
 
 class BoolField(BaseField):
+    _as_stored = True
+
     def parse(self, json_data):
         return self._parse(json_data)
 
@@ -106,46 +106,88 @@ class ModelBase(type):
         for field_name in fields:
             setattr(cls, field_name, cls._get_path(field_name, attrs[field_name]))
             attrs[field_name]._name = field_name
+        cls._fields = getattr(cls, '_fields', ()) + tuple([attrs[field_name] for field_name in fields])
+        cls._overlaps = dict([(field, tuple([other for other in cls._fields if _overlapping(field.path, other.path)]))
+                              for field in cls._fields])
         if attrs.has_key("finders"):
             setattr(cls, "objects", ModelManager(cls, attrs["finders"]))
         else:
             setattr(cls, "objects", ModelManager(cls, {}))
-        if attrs.has_key("headers"):
-            setattr(cls.objects, "headers", attrs["headers"])
+        _configure_manager(cls.objects, attrs)
 
     def _get_path(cls, field_name, field_impl):
+        if getattr(field_impl, '_as_stored', False) and cls._parse_field.im_func is Model._parse_field.im_func:
+            get = field_impl._get
+            return property(fget=lambda cls: get(cls._json),fset=lambda cls, value : cls._set_field(field_impl, value) )
         return property(fget=lambda cls: cls._parse_field(field_impl),fset=lambda cls, value : cls._set_field(field_impl, value) )
 
 class Model:
     __metaclass__ = ModelBase
+    _frozen = False
 
     def __init__(self,json_data=None,**kw):
+        self._cache = {}
         if kw.has_key('json'):
-            self._json = AttrDict(kw['json'])
+            self._json = _plain(kw['json'])
         else:
             try:
-                self._json = AttrDict(json.loads(json_data or '{}'))
+                self._json = _timed_parse(self.__class__, json.loads, json_data or '{}')
             except:
                 raise ValidationError("Invalid JSON")
         self.validate_on_load()
 
+    @classmethod
+    def from_stream(cls, stream):
+        "Builds the model from a file like object"
+        return cls(stream.read())
+
+    @classmethod
+    def _hydrate(cls, json_data):
+        return cls(json_data)
+
+    @classmethod
+    def _field_values(cls, json_data):
+        "The decoded json of a record, as plain dicts and lists to pass between processes"
+        return cls(json_data)._json
+
+    @classmethod
+    def _from_field_values(cls, json_data, values):
+        return cls(json=values)
+
     def validate_on_load(self):
         pass
 
     def _parse_field(self, field):
-        return field.parse(self._json)
+        try:
+            return self._cache[field]
+        except KeyError:
+            value = self._cache[field] = field.parse(self._json)
+            if self._frozen:
+                _set_immutable(value, True)
+            return value
+
+    def _freeze(self, immutable):
+        "Sub-models share their parent's json, so they are made immutable along with it"
+        self._frozen = immutable
+        for value in self._cache.values():
+            _set_immutable(value, immutable)
+
+    _immutable = property(lambda self: self._frozen, _freeze)
+
+    def _clone(self):
+        "A copy of this model that shares no data with it"
+        return type(self)(json=_copy_json(self._json))
 
     def _set_field(self, field, value):
-        value = field.save(value)
-        nodes = field.path.split('.')
-        self.set_nested_value(self._json,nodes, value)
+        if self._immutable:
+            raise ImmutableModelError("%s is shared and cannot be changed" % type(self).__name__)
+        field._set(self._json, _plain(field.save(value)))
+        if self._cache:
+            for stale in self._overlaps.get(field, (field,)):
+                self._cache.pop(stale, None)
 
     def set_nested_value(self, data, nodes, value):
-        node = nodes.pop(0)
-        if len(nodes) > 0:
-            self.set_nested_value(getattr(data,node),nodes, value)
-        else:
-            setattr(data,node, value)
+        _compiled_setter('.'.join(nodes))(_plain(data), value)
 
     def __unicode__(self):
         return json.dumps(self._json,separators=(',',':'))
@@ -153,28 +195,162 @@ class Model:
     def __str__(self):
         return self.__unicode__()
 
-class AttrDict(dict):
+def _set_immutable(value, immutable):
+    "Sets the immutability of value, if it is a model, or of the models in it, if it is a list"
+    if isinstance(value, Model):
+        value._immutable = immutable
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, Model):
+                item._immutable = immutable
+
+def _overlapping(path, other):
+    "Whether setting one path could change the value at the other, as one is the other or inside it"
+    return path == other or other.startswith(path + '.') or path.startswith(other + '.')
+
+_getters = {}
+_setters = {}
+
+def _compiled_getter(path, default):
+    """
+    A function reading the value at a dotted path from decoded json, as a chain of dict lookups generated
+    once per path and default, giving default where the value is missing, null or an empty object.  Lookups
+    along the path fall back to a shared empty dict, so a missing object neither raises nor is added.
+    """
+    key = (path, type(default), default)
+    try:
+        return _getters[key]
+    except KeyError:
+        getter = _getters[key] = _generate_getter(path, default)
+        return getter
+    except TypeError:
+        return _generate_getter(path, default)
+
+def _generate_getter(path, default):
+    nodes = path.split('.')
+    lookup = 'data'
+    for node in nodes[:-1]:
+        lookup = '_get(%s, %r, _empty)' % (lookup, node)
+    lookup = '_get(%s, %r)' % (lookup, nodes[-1])
+    return _generate(
+        "def get(data, _get=dict.get, _empty={}, default=default):\n"
+        "    try:\n"
+        "        value = %s\n"
+        "    except TypeError:\n"
+        "        return default\n"
+        "    if value is None or value == {}:\n"
+        "        return default\n"
+        "    return value\n" % lookup, 'get', default=default)
+
+def _compiled_setter(path):
+    "A function setting the value at a dotted path in decoded json, adding any objects missing or null along it"
+    if not _setters.has_key(path):
+        nodes = path.split('.')
+        lines = ["def set(data, value):"]
+        for node in nodes[:-1]:
+            lines.append("    child = data.get(%r)" % node)
+            lines.append("    if child is None:")
+            lines.append("        child = data[%r] = {}" % node)
+            lines.append("    data = child")
+        lines.append("    data[%r] = value" % nodes[-1])
+        _setters[path] = _generate('\n'.join(lines) + '\n', 'set')
+    return _setters[path]
+
+def _generate(source, name, **namespace):
+    exec compile(source, '<json path>', 'exec') in namespace
+    return namespace[name]
+
+def _copy_json(value):
+    if isinstance(value, dict):
+        return dict([(key, _copy_json(item)) for key, item in value.items()])
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    return value
+
+class AttrDict(object):
+    """
+    Attribute and item access to a decoded json object, as a view onto it rather than a copy.  Objects
+    inside it are wrapped only as they are read, and reading a missing key gives None without adding it.
+    It is not a dict, so isinstance(view, dict) is False; pass json.dumps view.to_dict(), the dict it views.
+    Keys named like its methods, e.g. 'items', are read with view['items'].
+    """
+    __slots__ = ('_data',)
+
     def __init__(self, value=None):
         if value is None:
-            pass
-        elif isinstance(value,dict):
-            for key in value:
-                self.__setitem__(key,value[key])
-        else:
-            TypeError, 'expected Dict'
+            value = {}
+        elif not isinstance(value, (dict, AttrDict)):
+            raise TypeError('expected dict, got %s' % type(value).__name__)
+        object.__setattr__(self, '_data', _plain(value))
 
-    def __setitem__(self,key,value):
-        if isinstance(value,dict) and not isinstance(value, AttrDict):
-            value = AttrDict(value)
-        dict.__setitem__(self,key,value)
+    def __getitem__(self, key):
+        return _view(self._data.get(key))
 
-    place_holder = object()
-    def __getitem__(self,key):
-        found = self.get(key, AttrDict.place_holder)
-        if found is AttrDict.place_holder:
-            found = AttrDict()
-            dict.__setitem__(self,key,found)
-        return found
+    def __setitem__(self, key, value):
+        self._data[key] = _plain(value)
+
+    def __getattr__(self, key):
+        if key.startswith('__') or key == '_data':
+            raise AttributeError(key)
+        return self[key]
 
     __setattr__ = __setitem__
-    __getattr__ = __getitem__
+
+    def __getstate__(self):
+        return self._data
+
+    def __setstate__(self, data):
+        object.__setattr__(self, '_data', data)
+
+    def get(self, key, default=None):
+        return _view(self._data.get(key, default))
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return [_view(value) for value in self._data.values()]
+
+    def items(self):
+        return [(key, _view(value)) for key, value in self._data.items()]
+
+    def has_key(self, key):
+        return key in self._data
+
+    def update(self, other=(), **kw):
+        for key, value in dict(_plain(other), **kw).items():
+            self[key] = value
+
+    def to_dict(self):
+        return self._data
+
+    def __eq__(self, other):
+        return self._data == _plain(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'AttrDict(%r)' % (self._data,)
+
+def _view(value):
+    if isinstance(value, dict):
+        return AttrDict(value)
+    return value
+
+def _plain(value):
+    if isinstance(value, AttrDict):
+        return value._data
+    return value
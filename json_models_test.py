@@ -26,12 +26,13 @@ authors and should not be interpreted as representing official policies, either
 or implied, of the FreeBSD Project.
 """
 
-import unittest, json
+import unittest, json, time, threading, itertools
 from datetime import datetime
 from mock import patch
 from StringIO import StringIO
 from json_models import *
 from common_models import *
+from common_models.common_models import _json_records
 
 class Address(Model):
     number = IntField(path='number')
@@ -67,6 +68,22 @@ class Simple(Model):
               }
     headers = {'user': 'user1', 'password': 'pwd1'}
 
+class Coalesced(Model):
+    field1 = CharField(path='field1')
+
+    finders = {
+               (field1,): "http://foo.com/coalesced/%s"
+              }
+    coalescing = Coalescing()
+
+class Paged(Model):
+    field1 = CharField(path='field1')
+
+    finders = {
+               (field1,): "http://foo.com/paged/%s"
+              }
+    pagination = OffsetPagination(page_size=2)
+
 class SimpleWithoutFinder(Model):
     field1 = CharField(path='field1')
 
@@ -155,6 +172,43 @@ class JsonModelsTest(unittest.TestCase):
         self.assertEquals('fuzzy', my_model.muppet_hair)
 
 
+    def test_reading_missing_attributes_leaves_the_json_unchanged(self):
+        my_model = MyModel('{"kiddie":null}')
+        self.assertEquals('fuzzy', my_model.muppet_hair)
+        self.assertEquals(None, my_model.muppet_name)
+        self.assertEquals('{"kiddie":null}', str(my_model))
+
+    def test_paths_may_name_dict_methods(self):
+        json_data = AttrDict(json.loads('{"items":{"keys":"Rowlf"}}'))
+        self.assertEquals('Rowlf', CharField(path="items.keys").parse(json_data))
+
+    def test_attr_dict_is_a_view_that_reads_never_add_to(self):
+        data = json.loads('{"kiddie":{"value":"Rowlf"}}')
+        view = AttrDict(data)
+        self.assertEquals('Rowlf', view.kiddie.value)
+        self.assertEquals(None, view.kiddie.missing)
+        view.kiddie.type = 'dog'
+        self.assertEquals({'kiddie': {'value': 'Rowlf', 'type': 'dog'}}, data)
+
+    def test_attr_dict_keeps_the_dict_methods_it_views(self):
+        view = AttrDict({'kiddie': {'value': 'Rowlf'}})
+        view.update({'type': 'dog'}, age=3)
+        self.assertTrue(view.has_key('type'))
+        self.assertEquals('Rowlf', dict(view.items())['kiddie'].value)
+        self.assertEquals(3, len(view.values()))
+        self.assertEquals({'kiddie': {'value': 'Rowlf'}, 'type': 'dog', 'age': 3}, json.loads(json.dumps(view.to_dict())))
+
+    def test_sub_models_share_the_json_of_their_parent(self):
+        my_model = MyModel('{"kiddie":{"value":"Rowlf","address":[{"number":10}]}}')
+        my_model.muppet_addresses[0].street = 'Sesame Street'
+        self.assertEquals('Sesame Street', json.loads(str(my_model))['kiddie']['address'][0]['street'])
+
+    def test_setting_a_nested_attribute_adds_the_objects_along_its_path(self):
+        my_model = MyModel('{}')
+        my_model.muppet_hair = 'bald'
+        self.assertEquals('bald', my_model.muppet_hair)
+        self.assertEquals({'kiddie': {'looks': {'head': {'hair': 'bald'}}}}, json.loads(str(my_model)))
+
     def test_collection_returns_expected_number_of_correcty_typed_results(self):
         my_model = MyModel('{"kiddie":{"names": ["Rowlf","Kermit","Ms.Piggy"]}}')
         self.assertTrue('Rowlf' in my_model.muppet_names)
@@ -209,6 +263,26 @@ class JsonModelsTest(unittest.TestCase):
         my_model.opened = None
         self.assertEquals(None, my_model.opened)
 
+    def test_converted_values_and_sub_models_are_kept_between_reads(self):
+        my_model = MyModel('{"kiddie":{"value":"Rowlf","address":[{"number":10},{"number":5}]}}')
+        addresses = my_model.muppet_addresses
+        self.assertTrue(addresses is my_model.muppet_addresses)
+        my_model.muppet_name = "Kermit"
+        self.assertTrue(addresses is my_model.muppet_addresses)
+
+    def test_setting_a_field_forgets_the_values_it_changes(self):
+        class Kiddie(Model):
+            opened = DateField(path='kiddie.opened')
+            addresses = Collection(Address, path='kiddie.address')
+            kiddie = CharField(path='kiddie')
+        kiddie = Kiddie('{"kiddie":{"opened":135,"address":[{"number":10}]}}')
+        self.assertEquals(1, len(kiddie.addresses))
+        kiddie.opened = datetime(1980,1,1)
+        self.assertEquals(datetime(1980,1,1), kiddie.opened)
+        kiddie.kiddie = {"address": []}
+        self.assertEquals([], kiddie.addresses)
+        self.assertEquals(None, kiddie.opened)
+
     def test_collection_fields_can_be_appended_to(self):
         my_model = MyModel('{"kiddie":{"names": ["Kermit"]}}')
         my_model.muppet_names.append("Fozzie")
@@ -244,6 +318,30 @@ class JsonModelsTest(unittest.TestCase):
         self.assertEquals(2, count)
         self.assertTrue(mock_get.called)
 
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_reads_records_from_a_top_level_array(self, mock_get):
+        class t:
+            content = StringIO(' [{"field1": "hello, [world]"}, {"field1": "goodbye"}]')
+        mock_get.return_value = t()
+        self.assertEquals(["hello, [world]", "goodbye"], [model.field1 for model in Simple.objects.filter(field1="baz")])
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_reads_records_from_the_record_path(self, mock_get):
+        class Enveloped(Model):
+            field1 = CharField(path='field1')
+            finders = { (field1,): "http://foo.com/enveloped/%s" }
+            record_path = 'results.*'
+        class t:
+            content = StringIO('{"meta": {"results": [1]}, "results": [{"field1": "hello"}, {"field1": "goodbye"}], "count": 2}')
+        mock_get.return_value = t()
+        self.assertEquals(["hello", "goodbye"], [model.field1 for model in Enveloped.objects.filter(field1="baz")])
+
+    def test_json_records_are_read_a_chunk_at_a_time(self):
+        document = '{"results": [{"a": "x\\"]}", "b": [1, {"c": 2}]}, 4, "s", []]}'
+        for chunk_size in (1, 3, 16384):
+            records = list(_json_records(StringIO(document), ['results', '*'], chunk_size))
+            self.assertEquals(json.loads(document)['results'], [json.loads(record) for record in records])
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_queries_rest_service_when_getting_for_a_registered_finder(self, mock_get):
         class t:
@@ -359,6 +457,90 @@ class JsonModelsTest(unittest.TestCase):
         qry = Simple.objects.filter(field1="baz")
         self.assertEquals(2, len(qry))
 
+    @patch.object(rest_client.AsyncClient, "GET")
+    def test_manager_aget_returns_a_pending_model(self, mock_get):
+        class t:
+            content = StringIO('{"field1": "hello"}')
+            response_code = 200
+        mock_get.return_value = rest_client.Pending.completed(t())
+        pending = Simple.objects.aget(field1="baz")
+        self.assertEquals("hello", pending.result().field1)
+        self.assertEquals("http://foo.com/simple/baz", mock_get.call_args[0][0])
+
+    @patch.object(rest_client.AsyncClient, "GET")
+    def test_manager_acount_and_alist_return_pending_results(self, mock_get):
+        class t:
+            content = StringIO('{"field1": "hello"}\n{"field1": "goodbye"}')
+        mock_get.return_value = rest_client.Pending.completed(t())
+        self.assertEquals(2, Simple.objects.filter(field1="baz").acount().result())
+        t.content = StringIO('{"field1": "hello"}\n{"field1": "goodbye"}')
+        self.assertEquals(["hello", "goodbye"], [m.field1 for m in Simple.objects.filter(field1="baz").alist().result()])
+
+    @patch.object(rest_client.AsyncClient, "GET")
+    def test_manager_aget_raises_does_not_exist_from_result(self, mock_get):
+        class t:
+            content = StringIO('')
+            response_code = 404
+        mock_get.return_value = rest_client.Pending.completed(t())
+        self.assertRaises(DoesNotExist, Simple.objects.aget(field1="baz").result)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_get_many_returns_results_in_order_with_does_not_exist_in_place(self, mock_get):
+        def respond(url, headers={}):
+            class t:
+                content = StringIO('{"field1": "%s"}' % url.split('/')[-1])
+                response_code = url.endswith('missing') and 404 or 200
+            return t()
+        mock_get.side_effect = respond
+        results = Simple.objects.get_many([{'field1': 'a'}, {'field1': 'missing'}, {'field1': 'c'}], max_concurrency=2)
+        self.assertEquals('a', results[0].field1)
+        self.assertTrue(isinstance(results[1], DoesNotExist))
+        self.assertEquals('c', results[2].field1)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_get_many_fetches_concurrently(self, mock_get):
+        def respond(url, headers={}):
+            time.sleep(0.1)
+            class t:
+                content = StringIO('{"field1": "x"}')
+                response_code = 200
+            return t()
+        mock_get.side_effect = respond
+        start = time.time()
+        results = Simple.objects.get_many([{'field1': str(i)} for i in range(10)], max_concurrency=10)
+        self.assertEquals(10, len(results))
+        self.assertTrue(time.time() - start < 0.5)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_get_many_uses_the_instance_cache_entered_on_the_calling_thread(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "%s"}' % url.split('/')[-1]), 'response_code': 200})()
+        with InstanceCache():
+            Simple.objects.get(field1='a')
+            results = Simple.objects.get_many([{'field1': 'a'}, {'field1': 'b'}, {'field1': 'a'}], max_concurrency=1)
+        self.assertEquals(['a', 'b', 'a'], [model.field1 for model in results])
+        self.assertEquals(2, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_get_many_only_waits_on_the_limiter_for_requests_it_makes(self, mock_get):
+        class Limiter(object):
+            acquired = 0
+            def acquire(self, host):
+                self.acquired += 1
+            def release(self, host, elapsed, failed):
+                pass
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "%s"}' % url.split('/')[-1]), 'response_code': 200})()
+        Simple.objects.limiter = limiter = Limiter()
+        try:
+            with InstanceCache():
+                Simple.objects.get_many([{'field1': 'a'}, {'field1': 'b'}], max_concurrency=1)
+                Simple.objects.get_many([{'field1': 'a'}, {'field1': 'b'}, {'field1': 'c'}], max_concurrency=1)
+        finally:
+            Simple.objects.limiter = rest_client.default_limiter
+        self.assertEquals(3, limiter.acquired)
+
+    def test_manager_get_many_raises_for_an_unregistered_finder_before_fetching(self):
+        self.assertRaises(NoRegisteredFinderError, Simple.objects.get_many, [{'field1': 'a'}, {'foo': 'b'}])
+
     @stub(MyModel)
     def test_stub_allows_stubbing_return_values_for_queries(self):
         address1 = Address()
@@ -422,6 +604,349 @@ class JsonModelsTest(unittest.TestCase):
         self.assertTrue(query.headers != None)
         self.assertEquals('pwd1', query.headers['password'])
 
+    @patch.object(rest_client.Client, "GET")
+    def test_query_results_are_fetched_once_for_len_bool_indexing_and_iteration(self, mock_get):
+        class t:
+            content = StringIO('{"field1": "hello"}\n{"field1": "goodbye"}')
+        mock_get.return_value = t()
+        qry = Simple.objects.filter(field1="baz")
+        self.assertEquals(2, len(qry))
+        self.assertTrue(qry)
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in qry])
+        self.assertEquals("goodbye", qry[1].field1)
+        self.assertEquals(2, qry.count())
+        self.assertEquals(1, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_query_iterator_streams_without_keeping_results(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "hello"}\n{"field1": "goodbye"}')})()
+        qry = Simple.objects.filter(field1="baz")
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in qry.iterator()])
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in qry.iterator()])
+        self.assertEquals(2, mock_get.call_count)
+        self.assertTrue(qry._result_cache is None)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_query_results_are_refetched_after_further_filtering(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "hello"}')})()
+        qry = Address.objects.filter(number=1)
+        self.assertEquals(1, len(qry))
+        self.assertEquals(1, len(qry.filter(street="foo")))
+        self.assertEquals(2, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_iterates_over_a_spooled_body(self, mock_get):
+        class t:
+            content = rest_client.SpooledBody(StringIO('{"field1": "hello"}\n' * 100), 50)
+        mock_get.return_value = t()
+        self.assertEquals(['hello'] * 100, [model.field1 for model in Simple.objects.filter(field1="baz")])
+
+    def paged_responses(self, mock_get, total):
+        def respond(url, headers={}):
+            params = dict(param.split('=') for param in url.split('?')[1].split('&'))
+            offset, limit = int(params['offset']), int(params['limit'])
+            lines = ['{"field1": "%d"}' % i for i in range(offset, min(offset + limit, total))]
+            return type('t', (), {'content': StringIO('\n'.join(lines)), 'response_code': 200})()
+        mock_get.side_effect = respond
+
+    @patch.object(rest_client.Client, "GET")
+    def test_slicing_a_paged_query_fetches_only_the_pages_needed(self, mock_get):
+        self.paged_responses(mock_get, 100)
+        self.assertEquals(['51', '52', '53'], [model.field1 for model in Paged.objects.filter(field1="baz")[51:54]])
+        self.assertEquals(["http://foo.com/paged/baz?offset=51&limit=2", "http://foo.com/paged/baz?offset=53&limit=2"],
+                          [call[0][0] for call in mock_get.call_args_list])
+        self.assertEquals('7', Paged.objects.filter(field1="baz")[7].field1)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_stepped_slices_stop_at_the_page_of_their_last_result(self, mock_get):
+        class ByPage(Model):
+            field1 = CharField(path='field1')
+            finders = { (field1,): "http://foo.com/paged/%s" }
+            pagination = PagePagination(page_size=3)
+        def respond(url, headers={}):
+            first = (int(url.split('page=')[1].split('&')[0]) - 1) * 3
+            return type('t', (), {'content': StringIO('\n'.join(['{"field1": "%d"}' % i for i in range(first, first + 3)])), 'response_code': 200})()
+        mock_get.side_effect = respond
+        self.assertEquals(['1', '3', '5'], [model.field1 for model in ByPage.objects.filter(field1="baz")[1:7:2]])
+        self.assertEquals(2, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_iterating_a_paged_query_fetches_pages_as_they_are_reached(self, mock_get):
+        self.paged_responses(mock_get, 5)
+        results = Paged.objects.filter(field1="baz").iterator()
+        self.assertEquals(['0', '1', '2'], [results.next().field1 for i in range(3)])
+        self.assertEquals(2, mock_get.call_count)
+        self.assertEquals(['0', '1', '2', '3', '4'], [model.field1 for model in Paged.objects.filter(field1="baz")])
+        self.assertEquals(5, Paged.objects.filter(field1="baz").count())
+
+    @patch.object(rest_client.Client, "GET")
+    def test_looping_over_a_paged_query_keeps_only_the_pages_reached(self, mock_get):
+        self.paged_responses(mock_get, 12)
+        query = Paged.objects.filter(field1="baz")
+        for model in query:
+            break
+        self.assertEquals(1, mock_get.call_count)
+        self.assertTrue(query)
+        self.assertEquals('0', query[0].field1)
+        self.assertEquals(1, mock_get.call_count)
+        self.assertEquals(['0', '1', '2', '3'], [model.field1 for model in itertools.islice(query, 4)])
+        self.assertEquals(2, mock_get.call_count)
+        self.assertEquals(12, len(query))
+        self.assertEquals(7, mock_get.call_count)
+        self.assertEquals(12, len(list(query)))
+        self.assertEquals(7, mock_get.call_count)
+
+    @patch.object(rest_client.AsyncClient, "GET")
+    def test_acount_and_alist_read_through_the_pages_of_a_paged_query(self, mock_get):
+        self.paged_responses(mock_get, 5)
+        respond = mock_get.side_effect
+        mock_get.side_effect = lambda url, headers={}: rest_client.Pending.completed(respond(url, headers))
+        self.assertEquals(5, Paged.objects.filter(field1="baz").acount().result())
+        self.assertEquals(['0', '1', '2', '3', '4'], [model.field1 for model in Paged.objects.filter(field1="baz").alist().result()])
+        self.assertEquals(6, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_iterating_a_paged_query_reads_pages_ahead_in_the_background(self, mock_get):
+        self.paged_responses(mock_get, 5)
+        self.assertEquals(['0', '1', '2', '3', '4'], [model.field1 for model in Paged.objects.filter(field1="baz").iterator(prefetch=2)])
+        self.assertEquals(3, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_read_ahead_fetches_pages_within_the_limiter(self, mock_get):
+        class Limiter(object):
+            held = 0
+            def acquire(self, host):
+                self.held += 1
+            def release(self, host, elapsed, failed):
+                self.held -= 1
+        limiter = Limiter()
+        self.paged_responses(mock_get, 5)
+        respond = mock_get.side_effect
+        held = []
+        def limited(url, headers={}):
+            held.append(limiter.held)
+            return respond(url, headers)
+        mock_get.side_effect = limited
+        Paged.objects.limiter = limiter
+        try:
+            self.assertEquals(['0', '1', '2', '3', '4'], [model.field1 for model in Paged.objects.filter(field1="baz").iterator(prefetch=2)])
+        finally:
+            Paged.objects.limiter = rest_client.default_limiter
+        self.assertEquals([1, 1, 1], held)
+        self.assertEquals(0, limiter.held)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_read_ahead_stops_when_iteration_stops_early(self, mock_get):
+        self.paged_responses(mock_get, 1000)
+        results = Paged.objects.filter(field1="baz").iterator(prefetch=2)
+        self.assertEquals('0', results.next().field1)
+        results.close()
+        time.sleep(0.3)
+        fetched = mock_get.call_count
+        time.sleep(0.3)
+        self.assertEquals(fetched, mock_get.call_count)
+        self.assertTrue(fetched <= 5)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_parallel_hydration_yields_models_in_order(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('\n'.join(['{"field1": "%d"}' % i for i in range(25)]))})()
+        for backend in ('thread', 'process'):
+            Simple.objects.hydration = ParallelHydration(backend, workers=2, batch_size=3, max_in_flight=2)
+            try:
+                self.assertEquals([str(i) for i in range(25)], [model.field1 for model in Simple.objects.filter(field1="baz")])
+            finally:
+                Simple.objects.hydration.close()
+                Simple.objects.hydration = None
+
+    @patch.object(rest_client.Client, "GET")
+    def test_execute_with_stats_reports_what_the_query_took(self, mock_get):
+        self.paged_responses(mock_get, 5)
+        query = Paged.objects.filter(field1="baz")
+        self.assertEquals("Paged http://foo.com/paged/baz (finder field1), not run", str(query.explain()))
+        models, stats = query.execute_with_stats()
+        self.assertEquals(['0', '1', '2', '3', '4'], [model.field1 for model in models])
+        self.assertEquals((Paged, ('field1',), 3, 5), (stats.model, stats.finder, stats.requests, stats.records))
+        self.assertEquals(sum([len('{"field1": "%d"}' % i) for i in range(5)]) + 2, stats.bytes)
+        self.assertTrue(stats.total_time >= stats.http_time > 0)
+        self.assertEquals(5, len(query))
+        self.assertEquals(3, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_slow_query_log_keeps_the_stats_of_queries_over_its_threshold(self, mock_get):
+        def respond(url, headers={}):
+            time.sleep(0.05)
+            return type('t', (), {'content': StringIO('{"field1": "hello"}')})()
+        mock_get.side_effect = respond
+        log = SlowQueryLog(threshold=0.04)
+        Simple.objects.slow_query_log = log
+        try:
+            list(Simple.objects.filter(field1="baz"))
+        finally:
+            Simple.objects.slow_query_log = None
+        self.assertEquals(1, len(log.entries))
+        self.assertEquals((Simple, "http://foo.com/simple/baz", 1), (log.entries[0].model, log.entries[0].url, log.entries[0].records))
+        log.threshold = 10
+        log.observe(log.entries[0])
+        self.assertEquals(1, len(log.entries))
+
+    @patch.object(rest_client.Client, "GET")
+    def test_slow_query_log_keeps_the_stats_of_slow_gets_and_counts(self, mock_get):
+        def respond(url, headers={}):
+            time.sleep(0.05)
+            return type('t', (), {'content': StringIO('{"field1": "hello"}'), 'response_code': 200})()
+        mock_get.side_effect = respond
+        log = SlowQueryLog(threshold=0.0)
+        Simple.objects.slow_query_log = log
+        try:
+            Simple.objects.get(field1="baz")
+            Simple.objects.filter(field1="baz").count()
+        finally:
+            Simple.objects.slow_query_log = None
+        self.assertEquals([(1, 1), (1, 0)], [(stats.requests, stats.records) for stats in log.entries])
+        self.assertTrue(log.entries[0].http_time >= 0.05)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_queries_report_into_the_metrics_registry(self, mock_get):
+        self.paged_responses(mock_get, 5)
+        registry = rest_client.MetricsRegistry()
+        Paged.objects.metrics = registry
+        try:
+            list(Paged.objects.filter(field1="baz"))
+        finally:
+            Paged.objects.metrics = None
+        labels = ('Paged', 'field1')
+        self.assertEquals({labels: 3}, registry.query_requests.collect())
+        self.assertEquals({labels: 5}, registry.query_records.collect())
+        self.assertEquals(1, sum(registry.query_seconds.collect()[labels][0]))
+        self.assertEquals(5, sum(registry.parse_seconds.collect()[('Paged',)][0]))
+
+    def test_page_pagination_locates_the_page_holding_a_result(self):
+        pagination = PagePagination(page_size=50)
+        self.assertEquals(("http://foo.com/x?a=b&page=21&size=50", 10), pagination.locate("http://foo.com/x?a=b", 1010))
+
+    def test_cursor_pagination_follows_the_next_link(self):
+        pagination = CursorPagination()
+        class t:
+            headers = {'link': '<http://foo.com/x?cursor=abc>; rel="next", <http://foo.com/x>; rel="first"'}
+        self.assertEquals("http://foo.com/x?cursor=abc", pagination.following("http://foo.com/x", "http://foo.com/x", t(), 0, 10))
+        t.headers = {'link': '<http://foo.com/x>; rel="first"'}
+        self.assertTrue(pagination.following("http://foo.com/x", "http://foo.com/x", t(), 0, 10) is None)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_shared_instances_cannot_be_changed_through_their_sub_models(self, mock_get):
+        class Shared(Model):
+            muppet_name = CharField(path='kiddie.value')
+            muppet_addresses = Collection(Address, path='kiddie.address')
+            finders = { (muppet_name,): "http://foo.com/shared/%s" }
+            instance_cache = InstanceCache(share_instances=True)
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"kiddie":{"value":"Rowlf","address":[{"street":"Sesame"}]}}'), 'response_code': 200})()
+        shared = Shared.objects.get(muppet_name='Rowlf')
+        address = shared.muppet_addresses[0]
+        self.assertRaises(ImmutableModelError, setattr, address, 'street', 'Hacked')
+        self.assertEquals('Sesame', Shared.objects.get(muppet_name='Rowlf').muppet_addresses[0].street)
+        address = shared._clone().muppet_addresses[0]
+        address.street = 'Changed'
+        self.assertEquals('Changed', address.street)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_gets_are_served_from_the_instance_cache_until_invalidated(self, mock_get):
+        class Cached(Model):
+            field1 = CharField(path='field1')
+            finders = { (field1,): "http://foo.com/cached/%s" }
+            instance_cache = InstanceCache(ttl=60)
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "hello"}'), 'response_code': 200})()
+        first = Cached.objects.get(field1='x')
+        first.field1 = 'changed'
+        self.assertEquals('hello', Cached.objects.get(field1='x').field1)
+        self.assertEquals(1, mock_get.call_count)
+        Cached.objects.invalidate(field1='x')
+        Cached.objects.get(field1='x')
+        self.assertEquals(2, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_gets_of_custom_urls_are_cached_apart(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('{"field1": "%s"}' % url.split('/')[-1]), 'response_code': 200})()
+        with InstanceCache():
+            self.assertEquals('1', Simple.objects.filter_custom('http://a/1').get().field1)
+            self.assertEquals('2', Simple.objects.filter_custom('http://a/2').get().field1)
+            self.assertEquals('1', Simple.objects.filter_custom('http://a/1').get().field1)
+            self.assertEquals(2, mock_get.call_count)
+            Simple.objects.get(field1='1')
+            Simple.objects.invalidate(field1='1')
+            Simple.objects.get(field1='1')
+            self.assertEquals(4, mock_get.call_count)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_instance_cache_remembers_does_not_exist(self, mock_get):
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO(''), 'response_code': 404})()
+        with InstanceCache() as cache:
+            for i in range(2):
+                self.assertRaises(DoesNotExist, Simple.objects.get, field1='missing')
+        self.assertEquals(1, mock_get.call_count)
+        self.assertEquals((1, 1), (cache.hits, cache.misses))
+        self.assertRaises(DoesNotExist, Simple.objects.get, field1='missing')
+        self.assertEquals(2, mock_get.call_count)
+
+    def test_instance_cache_evicts_the_least_recently_used(self):
+        cache = InstanceCache(max_entries=2)
+        for key in ('a', 'b'):
+            cache.store(key, Simple())
+        cache.lookup('a')
+        cache.store('c', Simple())
+        self.assertTrue(cache.lookup('b') is None)
+        self.assertTrue(cache.lookup('a') is not None)
+        cache = InstanceCache(max_bytes=100)
+        cache.store('a', Simple(), 60)
+        cache.store('b', Simple(), 60)
+        self.assertEquals((None, 60), (cache.lookup('a'), cache.size))
+
+    def test_response_cache_specified_on_model_is_used_by_the_query_manager_client(self):
+        cache = rest_client.ResponseCache()
+        class Cached(Model):
+            field1 = CharField(path='field1')
+            response_cache = cache
+        self.assertTrue(Cached.objects.client.cache is cache)
+        self.assertTrue(Simple.objects.client.cache is None)
+
+    def get_concurrently(self, model, mock_get, callers=5):
+        def respond(url, headers={}):
+            time.sleep(0.2)
+            class t:
+                content = StringIO('{"field1": "hello"}')
+                response_code = 200
+            return t()
+        mock_get.side_effect = respond
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(model.objects.get(field1='x'))) for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @patch.object(rest_client.Client, "GET")
+    def test_concurrent_identical_gets_share_one_request_but_not_instances(self, mock_get):
+        Coalesced.objects.coalescing = Coalescing()
+        results = self.get_concurrently(Coalesced, mock_get)
+        self.assertEquals(1, mock_get.call_count)
+        self.assertEquals(['hello'] * 5, [result.field1 for result in results])
+        self.assertEquals(5, len(set([id(result) for result in results])))
+        self.assertEquals((1, 4), (Coalesced.objects.coalescing.fetches, Coalesced.objects.coalescing.coalesced))
+        results[0].field1 = 'changed'
+        self.assertEquals('hello', results[1].field1)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_concurrent_identical_gets_can_share_one_immutable_instance(self, mock_get):
+        Coalesced.objects.coalescing = Coalescing(share_instances=True)
+        results = self.get_concurrently(Coalesced, mock_get)
+        self.assertEquals(1, mock_get.call_count)
+        self.assertEquals(1, len(set([id(result) for result in results])))
+        try:
+            results[0].field1 = 'changed'
+            self.fail("Expected ImmutableModelError")
+        except ImmutableModelError:
+            pass
+
 if __name__=='__main__':
     unittest.main()
 
@@ -1,3 +1,10 @@
-from rest_client import Client, Response
+from rest_client import Client, Response, ResponseStream, ResponseTooLarge, DecompressingStream, SpooledBody, default_pool
+from pool import ConnectionPool
+from cache import ResponseCache
+from hedging import HedgingPolicy
+from instrumentation import RequestTiming, LatencyCollector, Histogram
+from limiter import AdaptiveLimiter, default_limiter
+from async_client import AsyncClient, EventLoop, Pending, gather, default_loop
+from metrics import MetricsRegistry, default_registry, metrics_app
 
-__all__=['Client', 'Response']
\ No newline at end of file
+__all__=['Client', 'Response', 'ResponseStream', 'ResponseTooLarge', 'DecompressingStream', 'SpooledBody', 'ConnectionPool', 'default_pool', 'ResponseCache', 'HedgingPolicy', 'RequestTiming', 'LatencyCollector', 'Histogram', 'AdaptiveLimiter', 'default_limiter', 'AsyncClient', 'EventLoop', 'Pending', 'gather', 'default_loop', 'MetricsRegistry', 'default_registry', 'metrics_app']
\ No newline at end of file
@@ -0,0 +1,285 @@
+__doc__="""A non-blocking REST client.  Requests are multiplexed over a single asyncore event loop, so
+one thread can keep many requests in flight.  Each call returns a Pending result straight away."""
+
+import asyncore, base64, httplib, socket, sys, tempfile, threading, time, urlparse
+from rest_client import Response
+from limiter import default_limiter
+
+class EventLoop(object):
+    """Drives every in flight request registered with it.  Requests queued on a limiter are handed off
+    to it, so they are started by whichever thread drives the loop rather than the one that let them through.
+    Any thread waiting on a result may drive the loop, one step at a time, so callbacks run on whichever
+    thread holds it when their request completes."""
+    def __init__(self, poll_interval=0.05):
+        self.map = {}
+        self.poll_interval = poll_interval
+        self._ready = []
+        self._handed_off = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._driving = threading.RLock()
+
+    def run_until_complete(self, pending):
+        while not pending.done():
+            if not self._step() and not pending.done():
+                raise RuntimeError("Waiting on a result with nothing in flight")
+        return pending.result()
+
+    def run(self):
+        "Runs until every in flight request has finished"
+        while self._step():
+            pass
+
+    def handoff(self, callback):
+        """Counts callback as in flight until it has run.  Returns a pair of functions: the first runs it
+        on the calling thread, the second may be called from any thread to queue it for the thread driving
+        the loop."""
+        self._lock.acquire()
+        try:
+            self._handed_off += 1
+        finally:
+            self._lock.release()
+        def now():
+            self._lock.acquire()
+            try:
+                self._handed_off -= 1
+            finally:
+                self._lock.release()
+            callback()
+        def later():
+            self._lock.acquire()
+            try:
+                self._handed_off -= 1
+                self._ready.append(callback)
+            finally:
+                self._lock.release()
+            self._wakeup.set()
+        return now, later
+
+    def _step(self):
+        "Runs the callbacks handed off since the last step, then polls once.  False once there is nothing left to wait on."
+        self._driving.acquire()
+        try:
+            self._wakeup.clear()
+            self._lock.acquire()
+            try:
+                ready, self._ready = self._ready, []
+                waiting = self._handed_off
+            finally:
+                self._lock.release()
+            for callback in ready:
+                callback()
+            if self.map:
+                asyncore.loop(timeout=self.poll_interval, map=self.map, count=1)
+                return True
+        finally:
+            self._driving.release()
+        if not ready:
+            if not waiting:
+                return False
+            self._wakeup.wait(self.poll_interval)
+        return True
+
+default_loop = EventLoop()
+
+
+class Pending(object):
+    """The eventual result of an asynchronous call.  Callbacks added with add_callback are invoked with
+    this Pending once it is done, then() chains a function over the result, and result() runs the
+    event loop until the value, or the exception raised in producing it, is available."""
+    def __init__(self, loop=None):
+        self.loop = loop or default_loop
+        self._done = False
+        self._callbacks = []
+
+    @classmethod
+    def completed(cls, value, loop=None):
+        pending = cls(loop)
+        pending.set_result(value)
+        return pending
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self.loop.run_until_complete(self)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_exception(self, exc_info):
+        "Takes the sys.exc_info() of the failure, so result() can re-raise it with its traceback"
+        self._finish(None, exc_info)
+
+    def add_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def then(self, func):
+        "Returns a new Pending for func applied to this result.  Failures pass straight through."
+        chained = Pending(self.loop)
+        def apply(pending):
+            if pending._exc_info:
+                return chained.set_exception(pending._exc_info)
+            try:
+                chained.set_result(func(pending._value))
+            except:
+                chained.set_exception(sys.exc_info())
+        self.add_callback(apply)
+        return chained
+
+    def _finish(self, value, exc_info):
+        self._value = value
+        self._exc_info = exc_info
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(pendings, loop=None):
+    "A Pending list of the results of every Pending supplied, in the order supplied"
+    pendings = list(pendings)
+    gathered = Pending(loop or (pendings and pendings[0].loop))
+    remaining = [len(pendings)]
+    def finished(pending):
+        remaining[0] -= 1
+        if remaining[0] == 0 and not gathered.done():
+            try:
+                gathered.set_result([p.result() for p in pendings])
+            except:
+                gathered.set_exception(sys.exc_info())
+    if not pendings:
+        gathered.set_result([])
+    for pending in pendings:
+        pending.add_callback(finished)
+    return gathered
+
+
+class AsyncClient(object):
+    """
+    The asynchronous counterpart of Client.  GET, PUT, POST and DELETE return a Pending Response
+    whose content is a file like object over the body.  Each request uses its own connection, which
+    the server closes once the response is sent.  The Pending completes once the whole reply has been
+    received; it is held in memory up to spool_threshold bytes and spilled to a temporary file beyond that.  Only http urls are supported.  Requests wait on
+    limiter, the shared AdaptiveLimiter unless another is supplied, or None for no limit; one that has to
+    queue, behind this client or a blocking caller, is started on the thread driving the loop.
+    """
+    def __init__(self, base_url, credentials=(None, None), loop=None, limiter=default_limiter, spool_threshold=1048576):
+        self.base_url = base_url or ""
+        self.loop = loop or default_loop
+        self.limiter = limiter
+        self.spool_threshold = spool_threshold
+        self._auth_header = None
+        if credentials[0] and credentials[1]:
+            self._auth_header = 'Basic ' + base64.b64encode('%s:%s' % credentials)
+
+    def GET(self, url, headers={}):
+        return self._make_request(url, 'GET', None, headers)
+
+    def PUT(self, url, payload=None, headers={}):
+        return self._make_request(url, 'PUT', payload, headers)
+
+    def POST(self, url, payload=None, headers={}):
+        return self._make_request(url, 'POST', payload, headers)
+
+    def DELETE(self, url, payload=None, headers={}):
+        return self._make_request(url, 'DELETE', payload, headers)
+
+    def _make_request(self, url, method, payload, headers):
+        full_url = self.base_url + url
+        parts = urlparse.urlsplit(full_url)
+        if parts.scheme != 'http':
+            raise ValueError("AsyncClient only supports http urls, not %s" % full_url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers, Host=parts.netloc, Connection='close')
+        if self._auth_header:
+            headers['Authorization'] = self._auth_header
+        if payload is not None:
+            headers['Content-Length'] = str(len(payload))
+        request = "%s %s HTTP/1.1\r\n" % (method, path)
+        request += "".join(["%s: %s\r\n" % header for header in headers.items()]) + "\r\n" + (payload or '')
+        pending = Pending(self.loop)
+        address = (parts.hostname, parts.port or 80)
+        if self.limiter is None:
+            _RequestDispatcher(self.loop, address, request, method, full_url, pending, self.spool_threshold)
+            return pending
+        def start():
+            started = time.time()
+            def finished(pending):
+                failed = pending._exc_info is not None or pending._value.response_code >= 500
+                self.limiter.release(parts.netloc, time.time() - started, failed)
+            pending.add_callback(finished)
+            try:
+                _RequestDispatcher(self.loop, address, request, method, full_url, pending, self.spool_threshold)
+            except:
+                pending.set_exception(sys.exc_info())
+        now, later = self.loop.handoff(start)
+        self.limiter.acquire_async(parts.netloc, now, later)
+        return pending
+
+
+class _RequestDispatcher(asyncore.dispatcher):
+    """Writes one request, spools the reply until the server closes the connection, then completes the
+    Pending with a Response read from the spool"""
+    def __init__(self, loop, address, request, method, url, pending, spool_threshold):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self._out = request
+        self._in = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self._method = method
+        self._url = url
+        self._pending = pending
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def writable(self):
+        return bool(self._out) or not self.connected
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._in.write(data)
+
+    def handle_close(self):
+        self.close()
+        if self._pending.done():
+            return self._in.close()
+        try:
+            self._in.seek(0)
+            response = httplib.HTTPResponse(_ReceivedSocket(self._in), method=self._method)
+            response.begin()
+        except:
+            self._in.close()
+            return self._pending.set_exception(sys.exc_info())
+        self._pending.set_result(Response(self._url, response.status, response.msg, response))
+
+    def handle_error(self):
+        exc_info = sys.exc_info()
+        self.close()
+        self._in.close()
+        if not self._pending.done():
+            self._pending.set_exception(exc_info)
+
+
+class _ReceivedSocket(object):
+    "Lets httplib parse a response that has already been read off the wire into spool"
+    def __init__(self, spool):
+        self._spool = spool
+
+    def makefile(self, *args):
+        return self._spool
@@ -0,0 +1,104 @@
+__doc__="""A size bounded, least recently used cache of GET responses, revalidated with their ETag and
+Last-Modified validators once their Cache-Control max-age has passed."""
+
+import re, threading, time
+from collections import OrderedDict
+
+class CachedResponse(object):
+    def __init__(self, response_code, headers, body, expires):
+        self.response_code = response_code
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.size = len(body) + sum([len(k) + len(v) for k, v in headers.items()])
+
+    etag = property(fget=lambda self: self.headers.get('etag'))
+    last_modified = property(fget=lambda self: self.headers.get('last-modified'))
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        "The conditional request headers that revalidate this response"
+        validators = {}
+        if self.etag:
+            validators['If-None-Match'] = self.etag
+        if self.last_modified:
+            validators['If-Modified-Since'] = self.last_modified
+        return validators
+
+
+class ResponseCache(object):
+    """
+    Holds response bodies up to max_bytes in total, evicting the least recently used first.  Only
+    responses that carry a validator or a positive max-age, and are not marked no-store, are kept.
+    hits counts responses served while still fresh, revalidations those confirmed by a 304 and
+    misses everything that had to be fetched in full.
+    """
+    max_age_pattern = re.compile(r"max-age=(\d+)")
+
+    def __init__(self, max_bytes=10 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def store(self, key, response_code, headers, body):
+        "Caches the response if its headers allow it, returning the CachedResponse or None"
+        cache_control = headers.get('cache-control', '').lower()
+        max_age = self.max_age_pattern.search(cache_control)
+        max_age = max_age and 'no-cache' not in cache_control and int(max_age.group(1)) or 0
+        entry = CachedResponse(response_code, dict(headers), body, time.time() + max_age)
+        if 'no-store' in cache_control or not (max_age or entry.etag or entry.last_modified) or entry.size > self.max_bytes:
+            return None
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        finally:
+            self._lock.release()
+        return entry
+
+    def revalidated(self, key, entry, headers):
+        "Refreshes entry from the headers of the 304 that confirmed it"
+        self.record('revalidations')
+        merged = dict(entry.headers)
+        for name in ('cache-control', 'etag', 'last-modified', 'date'):
+            if name in headers:
+                merged[name] = headers[name]
+        return self.store(key, entry.response_code, merged, entry.body) or entry
+
+    def record(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries, self.size = OrderedDict(), 0
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
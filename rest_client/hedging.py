@@ -0,0 +1,97 @@
+__doc__="""Hedged GETs: when a response is slower than usual, a duplicate request is sent and whichever
+answers first is used."""
+
+import Queue, sys, threading, time
+from collections import deque
+
+class HedgingPolicy(object):
+    """
+    Sends a duplicate GET if no response has arrived within the given percentile of recently observed
+    latencies (initial_delay seconds until min_samples have been seen).  Hedges are capped at
+    max_extra_load, as a fraction of all requests made under the policy.  The loser's response is
+    closed when it arrives, so its connection is not reused.  requests, hedges_fired and hedges_won
+    count how often a hedge was needed and how often it beat the original.
+    """
+    def __init__(self, percentile=95, initial_delay=0.1, max_extra_load=0.05, window=200, min_samples=20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.max_extra_load = max_extra_load
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        "Seconds to wait for a response before hedging"
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))]
+
+    def execute(self, send):
+        "Calls send, and again if it is slow, returning the first response to arrive"
+        started = time.time()
+        results = Queue.Queue()
+        self._lock.acquire()
+        try:
+            self.requests += 1
+        finally:
+            self._lock.release()
+        self._start(send, results, False)
+        in_flight = 1
+        try:
+            outcome = results.get(timeout=self.delay())
+        except Queue.Empty:
+            if self._take_hedge():
+                self._start(send, results, True)
+                in_flight += 1
+            outcome = results.get()
+        in_flight -= 1
+        while outcome[2] is not None and in_flight:
+            outcome = results.get()
+            in_flight -= 1
+        if in_flight:
+            self._discard(results, in_flight)
+        hedged, response, exc_info = outcome
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._lock.acquire()
+        try:
+            self._latencies.append(time.time() - started)
+            if hedged:
+                self.hedges_won += 1
+        finally:
+            self._lock.release()
+        return response
+
+    def _take_hedge(self):
+        self._lock.acquire()
+        try:
+            if self.hedges_fired + 1 > self.max_extra_load * self.requests:
+                return False
+            self.hedges_fired += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _start(self, send, results, hedged):
+        def attempt():
+            try:
+                results.put((hedged, send(), None))
+            except:
+                results.put((hedged, None, sys.exc_info()))
+        thread = threading.Thread(target=attempt)
+        thread.daemon = True
+        thread.start()
+
+    def _discard(self, results, count):
+        def close_losers():
+            for i in range(count):
+                hedged, response, exc_info = results.get()
+                if response is not None:
+                    response.content.close()
+        thread = threading.Thread(target=close_losers)
+        thread.daemon = True
+        thread.start()
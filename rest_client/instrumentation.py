@@ -0,0 +1,169 @@
+__doc__="""Timing hooks for Client requests, and a collector that keeps latency histograms from them."""
+
+import bisect, ctypes, ctypes.util, os, re, threading, time, urlparse
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6', use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return None
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        spec = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from an arbitrary point that never goes backwards, where the platform offers it
+monotonic = _clock_gettime() or time.time
+
+
+class RequestTiming(object):
+    """
+    The timeline of one request, handed to each listener as it progresses.  Listeners may define any
+    of pre_request, connected, first_byte and complete, each called with the RequestTiming.  started,
+    connected_at, first_byte_at and completed_at are monotonic timestamps; connected_at covers name
+    lookup and connecting, and equals started when a pooled connection was reused.
+    """
+    def __init__(self, listeners, method, url, bytes_sent=0):
+        self.listeners = listeners
+        self.method = method
+        self.url = url
+        self.host = urlparse.urlsplit(url).netloc
+        self.bytes_sent = bytes_sent
+        self.bytes_received = 0
+        self.reused = False
+        self.status = None
+        self.started = self.connected_at = self.first_byte_at = self.completed_at = None
+
+    def pre_request(self):
+        self.started = monotonic()
+        self._notify('pre_request')
+
+    def connected(self, reused=False):
+        self.reused = reused
+        self.connected_at = monotonic()
+        self._notify('connected')
+
+    def first_byte(self, status):
+        self.status = status
+        self.first_byte_at = monotonic()
+        if self.connected_at is None:
+            self.connected_at = self.first_byte_at
+        self._notify('first_byte')
+
+    def complete(self):
+        if self.completed_at is None:
+            self.completed_at = monotonic()
+            self._notify('complete')
+
+    def _notify(self, event):
+        for listener in self.listeners:
+            callback = getattr(listener, event, None)
+            if callback is not None:
+                callback(self)
+
+
+class TimedBody(object):
+    "Counts the bytes read from a response body, completing the RequestTiming at the end of it"
+    def __init__(self, body, timing):
+        self._body = body
+        self._timing = timing
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._body.read()
+        else:
+            data = self._body.read(amt)
+        return self._count(data, amt is None or not data)
+
+    def readline(self):
+        data = self._body.readline()
+        return self._count(data, not data)
+
+    def close(self):
+        self._body.close()
+        self._timing.complete()
+
+    def _count(self, data, finished):
+        self._timing.bytes_received += len(data)
+        if finished:
+            self._timing.complete()
+        return data
+
+
+class Histogram(object):
+    "Counts observations into cumulative upper bound buckets, keeping their count and sum"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percentile):
+        "The upper bound of the bucket holding the given percentile, None if it is past the last bucket"
+        target = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+
+class LatencyCollector(object):
+    """
+    A listener that keeps a Histogram of each phase of a request per host, and per finder url template
+    for the models added with add_model.  The phases are connect (name lookup and connecting), wait
+    (connected to the first byte of the response, i.e. server think time), transfer (reading the
+    body) and total.
+    """
+    phases = ('connect', 'wait', 'transfer', 'total')
+
+    def __init__(self):
+        self.by_host = {}
+        self.by_template = {}
+        self._templates = []
+        self._lock = threading.Lock()
+
+    def add_model(self, model):
+        for url, attrs in model.objects.finders.values():
+            pattern = re.compile('^' + '[^/]+'.join([re.escape(part) for part in url.split('%s')]) + '$')
+            self._templates.append((pattern, url))
+
+    def template_for(self, url):
+        for pattern, template in self._templates:
+            if pattern.match(url):
+                return template
+        return None
+
+    def complete(self, timing):
+        durations = dict(zip(self.phases, (timing.connected_at - timing.started,
+                                           timing.first_byte_at - timing.connected_at,
+                                           timing.completed_at - timing.first_byte_at,
+                                           timing.completed_at - timing.started)))
+        template = self.template_for(timing.url)
+        self._lock.acquire()
+        try:
+            self._observe(self.by_host, timing.host, durations)
+            if template is not None:
+                self._observe(self.by_template, template, durations)
+        finally:
+            self._lock.release()
+
+    def _observe(self, histograms, key, durations):
+        if key not in histograms:
+            histograms[key] = dict([(phase, Histogram()) for phase in self.phases])
+        for phase, duration in durations.items():
+            histograms[key][phase].observe(duration)
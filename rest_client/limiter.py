@@ -0,0 +1,106 @@
+__doc__="""An adaptive cap on the requests in flight to each host, shared by the parallel and asynchronous
+ways of fetching models."""
+
+import threading, time
+from collections import deque
+
+class AdaptiveLimiter(object):
+    """
+    Additive increase, multiplicative decrease: each request that succeeds within tolerance times the
+    host's baseline latency raises its limit by 1/limit, about one per round of requests, and each
+    failure or slow response multiplies it by backoff.  The baseline follows the fastest latencies
+    seen, drifting slowly upwards so that it can recover from a change in the upstream.  Callers over
+    the limit queue in order, stats(host) shows the limit, in flight and queued counts and the time
+    spent waiting.
+    """
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=500, backoff=0.7, tolerance=2.0, drift=0.01):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.drift = drift
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        "Blocks until a request to host may be sent"
+        event = threading.Event()
+        if not self._acquire_or_queue(host, event.set):
+            event.wait()
+
+    def acquire_async(self, host, start, wake=None):
+        """Calls start straight away if a request to host may be sent.  Otherwise the request queues, and
+        wake, or start if there is none, is called by the thread that releases the request ahead of it."""
+        if self._acquire_or_queue(host, wake or start):
+            start()
+
+    def release(self, host, latency, failed=False):
+        "Records how the request went, then lets the next queued request through if the limit allows"
+        self._lock.acquire()
+        try:
+            state = self._hosts[host]
+            state.in_flight -= 1
+            if failed or (state.baseline is not None and latency > self.tolerance * state.baseline):
+                state.limit = max(self.min_limit, state.limit * self.backoff)
+            else:
+                state.limit = min(self.max_limit, state.limit + 1.0 / state.limit)
+            if not failed:
+                if state.baseline is None or latency < state.baseline:
+                    state.baseline = latency
+                else:
+                    state.baseline += (latency - state.baseline) * self.drift
+            granted = self._grant(state)
+        finally:
+            self._lock.release()
+        for wake in granted:
+            wake()
+
+    def stats(self, host):
+        self._lock.acquire()
+        try:
+            state = self._state(host)
+            return {'limit': int(state.limit), 'in_flight': state.in_flight, 'queued': len(state.waiters),
+                    'waits': state.waits, 'total_wait': state.total_wait,
+                    'mean_wait': state.waits and state.total_wait / state.waits or 0.0}
+        finally:
+            self._lock.release()
+
+    def _acquire_or_queue(self, host, wake):
+        self._lock.acquire()
+        try:
+            state = self._state(host)
+            if not state.waiters and state.in_flight < int(state.limit):
+                state.in_flight += 1
+                return True
+            state.waiters.append((time.time(), wake))
+            return False
+        finally:
+            self._lock.release()
+
+    def _grant(self, state):
+        granted = []
+        now = time.time()
+        while state.waiters and state.in_flight < int(state.limit):
+            queued_at, wake = state.waiters.popleft()
+            state.in_flight += 1
+            state.waits += 1
+            state.total_wait += now - queued_at
+            granted.append(wake)
+        return granted
+
+    def _state(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = _HostLimit(self.initial_limit)
+        return self._hosts[host]
+
+class _HostLimit(object):
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.baseline = None
+        self.waiters = deque()
+        self.waits = 0
+        self.total_wait = 0.0
+
+default_limiter = AdaptiveLimiter()
@@ -0,0 +1,185 @@
+__doc__="""Counters and histograms of client and model traffic, rendered in the Prometheus text format."""
+
+import bisect, threading, weakref
+
+class _ShardOwner(object):
+    "Held only by a thread's local storage, so it is freed when the thread finishes"
+
+class _Metric(object):
+    """
+    Values are kept in a shard per thread, so recording takes no lock; a thread's first record adds its
+    shard to those that collect sums over, and once the thread finishes its shard is folded into the
+    totals kept for finished threads.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            self._lock.acquire()
+            try:
+                self._shards[weakref.ref(owner, self._retire)] = shard
+            finally:
+                self._lock.release()
+            return shard
+
+    def _retire(self, owner):
+        self._lock.acquire()
+        try:
+            shard = self._shards.pop(owner, None)
+            if shard:
+                self._merge(self._retired, shard)
+        finally:
+            self._lock.release()
+
+    def collect(self):
+        "The values recorded on every thread, summed per labels"
+        totals = {}
+        self._lock.acquire()
+        try:
+            self._merge(totals, self._retired)
+            for shard in self._shards.values():
+                self._merge(totals, shard)
+        finally:
+            self._lock.release()
+        return totals
+
+    def _label_text(self, labels, extra=()):
+        pairs = zip(self.labelnames, labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (name, _escape(value)) for name, value in pairs])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in sorted(self.collect().items()):
+            lines.extend(self._render_value(labels, value))
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    "A count per set of label values, e.g. counter.inc(('Address', 'city'))"
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, totals, shard):
+        for labels, value in shard.items():
+            totals[labels] = totals.get(labels, 0) + value
+
+    def _render_value(self, labels, value):
+        return ['%s%s %s' % (self.name, self._label_text(labels), _number(value))]
+
+class Histogram(_Metric):
+    "Counts observations into buckets, with upper bounds in seconds by default, per set of label values"
+    kind = 'histogram'
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels, value):
+        shard = self._shard()
+        entry = shard.get(labels)
+        if entry is None:
+            entry = shard[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def _merge(self, totals, shard):
+        "Adds shard to totals, each the count in each bucket, not cumulative, with the last for values above them all, and the sum, per labels"
+        for labels, (counts, total) in shard.items():
+            merged = totals.get(labels)
+            if merged is None:
+                totals[labels] = [list(counts), total]
+            else:
+                totals[labels] = [[a + b for a, b in zip(merged[0], counts)], merged[1] + total]
+
+    def _render_value(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self._label_text(labels, [('le', _number(bound))]), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._label_text(labels), _number(total)))
+        lines.append('%s_count%s %d' % (self.name, self._label_text(labels), cumulative))
+        return lines
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics reported by Clients and models given it as their metrics, and any added with
+    counter or histogram, and renders them all in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self._metrics = []
+        self.client_requests = self.counter('rest_client_requests_total', 'Requests made by Clients', ('method', 'host', 'status'))
+        self.client_errors = self.counter('rest_client_errors_total', 'Client requests that raised', ('method', 'host'))
+        self.client_seconds = self.histogram('rest_client_request_seconds', 'Time from sending a request to its response headers', ('method', 'host'))
+        query_labels = ('model', 'finder')
+        self.query_requests = self.counter('model_requests_total', 'Requests made for model queries', query_labels)
+        self.query_errors = self.counter('model_errors_total', 'Model queries that raised, other than DoesNotExist', query_labels)
+        self.query_bytes = self.counter('model_response_bytes_total', 'Bytes read for model queries', query_labels)
+        self.query_records = self.counter('model_records_total', 'Records read by model queries', query_labels)
+        self.query_seconds = self.histogram('model_query_seconds', 'Time taken by each model query', query_labels)
+        self.parse_seconds = self.histogram('model_parse_seconds', 'Time taken to parse each model document', ('model',))
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.default_buckets):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def observe_query(self, stats):
+        "Reports the QueryStats of a finished model query"
+        labels = self._query_labels(stats)
+        self.query_requests.inc(labels, stats.requests)
+        self.query_bytes.inc(labels, stats.bytes)
+        self.query_records.inc(labels, stats.records)
+        self.query_seconds.observe(labels, stats.total_time)
+
+    def observe_query_error(self, stats):
+        self.query_errors.inc(self._query_labels(stats))
+
+    def _query_labels(self, stats):
+        return (stats.model.__name__, stats.finder and ','.join(stats.finder) or 'custom')
+
+    def render(self):
+        return '\n'.join([metric.render() for metric in self._metrics]) + '\n'
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+default_registry = MetricsRegistry()
+
+def metrics_app(registry=default_registry):
+    "A WSGI application serving registry for Prometheus to scrape"
+    def app(environ, start_response):
+        body = registry.render()
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+def _escape(value):
+    return unicode(value).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,187 @@
+__doc__="""Per host pool of persistent (HTTP/1.1 keep-alive) connections, shared by every Client
+that does not ask for its own."""
+
+import httplib, select, socket, threading, time, urlparse
+
+class ConnectionPool(object):
+    """
+    Keeps up to max_per_host idle connections for each scheme, host and port.  A connection is
+    only handed back to the pool once its response body has been read to the end and the server
+    has not asked to close it.  Idle connections older than idle_timeout seconds, or that the
+    server has since closed, are discarded on checkout.  When block is False (the default) a
+    host that already has max_per_host connections in use gets an extra, unpooled connection;
+    when True the caller waits for one to be released.  A request that fails on a reused
+    connection the server has since dropped is sent again on a new one, but only if its method
+    is one of retry_methods, so requests that change things are never sent twice.
+    """
+    retry_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+    def __init__(self, max_per_host=10, idle_timeout=30, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, block=False):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.block = block
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._in_use = {}
+        self._lock = threading.Condition()
+
+    def urlopen(self, method, url, payload=None, headers={}, timing=None):
+        """Sends the request over a pooled connection, returning a PooledResponse.  A RequestTiming, if
+        given, is told when the connection is ready and when the response starts to arrive."""
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        key = (scheme, netloc)
+        conn, reused = self._checkout(key)
+        try:
+            try:
+                if timing is not None:
+                    if not reused:
+                        conn.connect()
+                    timing.connected(reused)
+                conn.request(method, path or '/', payload, headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if not reused or method not in self.retry_methods:
+                    raise
+                # The server dropped an idle keep-alive connection, try once more on a new one
+                conn.close()
+                conn.request(method, path or '/', payload, headers)
+                response = conn.getresponse()
+        except:
+            self._release(key, conn, False)
+            raise
+        if timing is not None:
+            timing.first_byte(response.status)
+        return PooledResponse(response, lambda reusable: self._release(key, conn, reusable))
+
+    def clear(self):
+        "Closes every idle connection"
+        self._lock.acquire()
+        try:
+            for connections in self._idle.values():
+                for conn, released_at in connections:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+    def _checkout(self, key):
+        self._lock.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key, [])
+                while idle:
+                    conn, released_at = idle.pop()
+                    if self._is_usable(conn, released_at):
+                        self._in_use[key] = self._in_use.get(key, 0) + 1
+                        self.reused += 1
+                        return conn, True
+                    conn.close()
+                if not self.block or self._in_use.get(key, 0) < self.max_per_host:
+                    break
+                self._lock.wait()
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            self.created += 1
+        finally:
+            self._lock.release()
+        return self._connect(key), False
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _is_usable(self, conn, released_at):
+        if conn.sock is None or time.time() - released_at > self.idle_timeout:
+            return False
+        try:
+            readable, writable, errored = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        # An idle connection has nothing to say, if it is readable the server has closed it
+        return not readable
+
+    def _release(self, key, conn, reusable):
+        self._lock.acquire()
+        try:
+            self._in_use[key] -= 1
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+            else:
+                conn.close()
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+
+class PooledResponse(object):
+    """File like wrapper around an httplib response.  The connection goes back to the pool as soon
+    as the body has been read to the end, straight away if there is none, as for a HEAD, or is closed
+    if the body is closed part way through, or dropped without being closed."""
+
+    chunk_size = 16384
+
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+        self._buffer = ''
+        self.status = response.status
+        self.headers = response.msg
+        if getattr(response, 'length', None) == 0:
+            response.close()
+        if response.isclosed():
+            self._done(not response.will_close)
+
+    def read(self, amt=None):
+        if amt is None:
+            data, self._buffer = self._buffer + self._read_raw(None), ''
+            return data
+        if not self._buffer:
+            return self._read_raw(amt)
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self):
+        while '\n' not in self._buffer:
+            chunk = self._read_raw(self.chunk_size)
+            if not chunk:
+                break
+            self._buffer += chunk
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        if self._release is not None:
+            self._response.close()
+            self._done(False)
+
+    def __del__(self):
+        if getattr(self, '_release', None) is not None:
+            self.close()
+
+    def _read_raw(self, amt):
+        if self._release is None:
+            return ''
+        data = self._response.read() if amt is None else self._response.read(amt)
+        if self._response.isclosed() or not data:
+            self._done(not self._response.will_close)
+        return data
+
+    def _done(self, reusable):
+        release, self._release = self._release, None
+        release(reusable)
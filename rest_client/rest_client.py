@@ -27,20 +27,49 @@ or implied, of the FreeBSD Project.
 """
 
 
-__doc__="A REST client, supporting GET, PUT, POST and DELETE"
+__doc__="A REST client, supporting GET, PUT, POST, DELETE and HEAD"
 
-import urllib2
+import urllib2, urlparse, base64, zlib, mmap, tempfile
+from StringIO import StringIO
+from pool import ConnectionPool
+from instrumentation import RequestTiming, TimedBody, monotonic
+
+default_pool = ConnectionPool()
 
 class Client(object):
     """ 
     A new Client takes a base_url e.g. http://www.mysite.com:8765/rest and 
     optionally a tuple containing username and password for use as basic 
-    auth.  
+    auth.  Requests go over keep-alive connections from the shared default_pool,
+    unless another ConnectionPool is supplied, or pool=None to open a new
+    connection for every request.  GETs are served from, and revalidated
+    against, cache if a ResponseCache is supplied.  With decompress=True the
+    client asks for gzip or deflate encoded responses and inflates them as
+    they are read.  Slow GETs are duplicated according to hedging, if a
+    HedgingPolicy is supplied.  Listeners added with add_listener are told
+    how each request progresses, see instrumentation.RequestTiming.  With a
+    spool_threshold, each body is read off the wire straight away, kept in
+    memory up to that many bytes and spilled to a memory mapped temporary
+    file beyond it.  Requests are counted and timed in metrics, if a
+    MetricsRegistry is supplied.
     """
-    def __init__(self, base_url, credentials=(None, None)):
+    def __init__(self, base_url, credentials=(None, None), pool=default_pool, cache=None, decompress=False, hedging=None, spool_threshold=None, metrics=None):
         self.base_url = base_url or ""
+        self.pool = pool
+        self.cache = cache
+        self.decompress = decompress
+        self.hedging = hedging
+        self.spool_threshold = spool_threshold
+        self.metrics = metrics
+        self.listeners = []
         self._install_creds(base_url, credentials)
     
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
     def GET(self, url, headers={}):
         return self._make_request(url, 'GET', None, headers)
         
@@ -52,21 +81,78 @@ class Client(object):
         
     def DELETE(self, url, payload=None, headers={}):
             return self._make_request(url, 'DELETE', payload, headers)
+
+    def HEAD(self, url, headers={}):
+        return self._send(url, 'HEAD', None, headers)
         
     def _install_creds(self, base_url, credentials):
         if credentials[0] and credentials[1]:
             user, passwd = credentials
             pwm = urllib2.HTTPPasswordMgrWithDefaultRealm()
             pwm.add_password(None, base_url, user, passwd)
-            handler = urllib2.HTTPBasicAuthHandler(pwm)
-            handler.set_parent(urllib2.HTTPHandler())
-            self.opener = handler.build_opener()
+            self._auth_header = 'Basic ' + base64.b64encode('%s:%s' % (user, passwd))
         else:
-            self.opener = urllib2.OpenerDirector()
-            self.opener.add_handler(urllib2.HTTPHandler())
-            self.opener.add_handler(urllib2.HTTPSHandler())
+            pwm = None
+            self._auth_header = None
+        self.opener = urllib2.OpenerDirector()
+        self.opener.add_handler(urllib2.HTTPHandler())
+        self.opener.add_handler(urllib2.HTTPSHandler())
+        if pwm:
+            self.opener.add_handler(urllib2.HTTPBasicAuthHandler(pwm))
     
     def _make_request(self, url, method, payload, headers):
+        if self.cache is not None and method == 'GET':
+            return self._make_cached_request(url, headers)
+        return self._send(url, method, payload, headers)
+
+    def _send(self, url, method, payload, headers):
+        if self.metrics is None:
+            return self._exchange(url, method, payload, headers)
+        host = urlparse.urlsplit(self.base_url + url).netloc
+        started = monotonic()
+        try:
+            response = self._exchange(url, method, payload, headers)
+        except Exception:
+            self.metrics.client_errors.inc((method, host))
+            raise
+        self.metrics.client_requests.inc((method, host, str(response.response_code)))
+        self.metrics.client_seconds.observe((method, host), monotonic() - started)
+        return response
+
+    def _exchange(self, url, method, payload, headers):
+        if self.decompress:
+            headers = dict(headers)
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if self.hedging is not None and method == 'GET':
+            response = self.hedging.execute(lambda: self._send_once(url, method, payload, headers))
+        else:
+            response = self._send_once(url, method, payload, headers)
+        encoding = response.headers.get('content-encoding', '').lower()
+        if self.decompress and encoding in ('gzip', 'deflate'):
+            headers = dict([(k, v) for k, v in response.headers.items() if k not in ('content-encoding', 'content-length')])
+            response = Response(response.url, response.response_code, headers, DecompressingStream(response.content, encoding))
+        if self.spool_threshold is not None:
+            return Response(response.url, response.response_code, response.headers, SpooledBody(response.content, self.spool_threshold))
+        return response
+
+    def _send_once(self, url, method, payload, headers):
+        if self.listeners:
+            return self._send_timed(url, method, payload, headers)
+        if self.pool is not None:
+            return self._make_pooled_request(url, method, payload, headers)
+        return self._make_unpooled_request(url, method, payload, headers)
+
+    def _send_timed(self, url, method, payload, headers):
+        timing = RequestTiming(list(self.listeners), method, self.base_url + url, len(payload or ''))
+        timing.pre_request()
+        if self.pool is not None:
+            response = self._make_pooled_request(url, method, payload, headers, timing)
+        else:
+            response = self._make_unpooled_request(url, method, payload, headers)
+            timing.first_byte(response.response_code)
+        return Response(response.url, response.response_code, response.headers, TimedBody(response.content, timing))
+
+    def _make_unpooled_request(self, url, method, payload, headers):
         request = urllib2.Request(self.base_url + url, headers=headers, data=payload)
         request.get_method = lambda: method
         response = self.opener.open(request)
@@ -74,6 +160,33 @@ class Client(object):
         if response_code == -1:
             raise urllib2.HTTPError(url, response_code, "Error accessing external resource", None, None)
         return Response(self.base_url + url, response_code, response.headers, response)
+
+    def _make_pooled_request(self, url, method, payload, headers, timing=None):
+        if self._auth_header:
+            headers = dict(headers, Authorization=self._auth_header)
+        response = self.pool.urlopen(method, self.base_url + url, payload, headers, timing)
+        return Response(self.base_url + url, response.status, response.headers, response)
+
+    def _make_cached_request(self, url, headers):
+        key = (self.base_url + url, tuple(sorted(headers.items())))
+        entry = self.cache.lookup(key)
+        if entry is not None and entry.is_fresh():
+            self.cache.record('hits')
+            return self._cached_response(url, entry)
+        request_headers = entry and dict(headers, **entry.validators()) or headers
+        response = self._send(url, 'GET', None, request_headers)
+        if entry is not None and response.response_code == 304:
+            response.content.read()
+            return self._cached_response(url, self.cache.revalidated(key, entry, response.headers))
+        self.cache.record('misses')
+        if response.response_code != 200:
+            return response
+        body = response.content.read()
+        self.cache.store(key, response.response_code, response.headers, body)
+        return Response(response.url, response.response_code, response.headers, StringIO(body))
+
+    def _cached_response(self, url, entry):
+        return Response(self.base_url + url, entry.response_code, entry.headers, StringIO(entry.body))
         
 class Response(object):
     """Encapsulates the response from a client GET/PUT/POST/DELETE call"""
@@ -82,17 +195,26 @@ class Response(object):
         self._url = url
         self._response_code = response_code
         self._headers = dict(headers)
-        self._content = content
+        self._content = ResponseStream.wrap(content)
         
-    url = property(fget=lambda : self._url, doc="The url this response was returned from")
+    url = property(fget=lambda self : self._url, doc="The url this response was returned from")
     response_code = property(fget=lambda self : self._response_code, doc="The response code returned from the call")
     headers = property(fget=lambda self : self._headers, doc="The headers returned in the response")
-    content = property(fget=lambda self : self._content, doc="The response body, as a string, returned from the call")
+    content = property(fget=lambda self : self._content, doc="The response body, as a ResponseStream, returned from the call")
         
     def expect(self, response_code):
         "If the actual response code does not match the expected response code, raises a HTTPError"
         if self.response_code != response_code:
             raise urllib2.HTTPError(self.url, self.response_code, "Expected response code: %s, but was %s" % (response_code, self.response_code), None, None)
+
+    def iter_chunks(self, size=16384):
+        return self.content.iter_chunks(size)
+
+    def readinto(self, buffer):
+        return self.content.readinto(buffer)
+
+    def read_all(self, max_bytes=None):
+        return self.content.read_all(max_bytes)
         
     def __getattr__(self, attr_name):
         if self.headers.has_key(attr_name):
@@ -101,4 +223,211 @@ class Response(object):
     
     def __str__(self):
         "returns the content of the response as a string"
-        return self.content
\ No newline at end of file
+        return self.content
+
+class ResponseTooLarge(Exception):
+    pass
+
+class DecompressingStream(object):
+    """Inflates a gzip or deflate encoded body as it is read, never holding more than a chunk of
+    either the encoded or the decoded body"""
+    chunk_size = 16384
+
+    def __init__(self, body, encoding):
+        self._body = body
+        self._raw_deflate_fallback = encoding == 'deflate'
+        self._decompressor = zlib.decompressobj(encoding == 'gzip' and 16 + zlib.MAX_WBITS or zlib.MAX_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, amt=None):
+        if amt is None:
+            chunks = [self._buffer]
+            self._buffer = ''
+            while not self._eof:
+                chunks.append(self._inflate(self.chunk_size))
+            return ''.join(chunks)
+        while len(self._buffer) < amt and not self._eof:
+            self._buffer += self._inflate(amt - len(self._buffer))
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self):
+        while '\n' not in self._buffer and not self._eof:
+            self._buffer += self._inflate(self.chunk_size)
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def close(self):
+        self._body.close()
+
+    def _inflate(self, max_length):
+        data = self._decompressor.unconsumed_tail or self._body.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            return self._decompressor.flush()
+        try:
+            inflated = self._decompressor.decompress(data, max_length)
+        except zlib.error:
+            if not self._raw_deflate_fallback:
+                raise
+            # Some servers send deflate without the zlib wrapper
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            inflated = self._decompressor.decompress(data, max_length)
+        self._raw_deflate_fallback = False
+        return inflated
+
+
+class SpooledBody(object):
+    """
+    Reads a whole body off the wire, holding it in memory up to threshold bytes and spilling anything
+    larger to a temporary file.  The body is then read back from buffer, a string or, once spilled, a
+    read only memory map of the file, so parsing a huge body does not grow the process heap.
+    """
+    chunk_size = 65536
+
+    def __init__(self, body, threshold):
+        chunks = []
+        spill = None
+        self.size = 0
+        for chunk in iter(lambda: body.read(self.chunk_size), ''):
+            self.size += len(chunk)
+            if spill is None and self.size > threshold:
+                spill = tempfile.TemporaryFile()
+                spill.write(''.join(chunks))
+                chunks = None
+            if spill is None:
+                chunks.append(chunk)
+            else:
+                spill.write(chunk)
+        self._spill = spill
+        if spill is None:
+            self.buffer = ''.join(chunks)
+            self._file = StringIO(self.buffer)
+        else:
+            spill.flush()
+            self.buffer = self._file = mmap.mmap(spill.fileno(), 0, access=mmap.ACCESS_READ)
+
+    spilled = property(fget=lambda self: self._spill is not None, doc="True if the body was spilled to disk")
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = self.size - self._file.tell()
+        return self._file.read(amt)
+
+    def readline(self):
+        return self._file.readline()
+
+    def seek(self, offset):
+        self._file.seek(offset)
+
+    def close(self):
+        self._file.close()
+        if self._spill is not None:
+            self._spill.close()
+
+
+class ResponseStream(object):
+    """
+    Reads a response body incrementally, whatever kind of file object it arrived as.  Consume it
+    once, with read, readline, line iteration, iter_chunks or readinto a reusable buffer, or
+    read_all to load it whole, refusing bodies larger than max_bytes.  bytes_read counts what has been
+    read off the body so far.
+    """
+    chunk_size = 16384
+
+    def __init__(self, body):
+        self._body = body
+        self._pushed_back = ''
+        self.bytes_read = 0
+
+    @classmethod
+    def wrap(cls, body):
+        if body is None or isinstance(body, cls):
+            return body
+        return cls(body)
+
+    def read(self, amt=None):
+        if self._pushed_back:
+            if amt is None:
+                data, self._pushed_back = self._pushed_back + self._counted(self._body.read()), ''
+            else:
+                data, self._pushed_back = self._pushed_back[:amt], self._pushed_back[amt:]
+            return data
+        if amt is None:
+            return self._counted(self._body.read())
+        return self._counted(self._body.read(amt))
+
+    def readline(self):
+        if '\n' in self._pushed_back:
+            end = self._pushed_back.index('\n') + 1
+            line, self._pushed_back = self._pushed_back[:end], self._pushed_back[end:]
+            return line
+        line, self._pushed_back = self._pushed_back + self._counted(self._body.readline()), ''
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def readlines(self):
+        return list(self)
+
+    def readinto(self, buffer):
+        "Reads up to len(buffer) bytes into buffer, a bytearray or memoryview, returning the count read"
+        view = memoryview(buffer)
+        if not self._pushed_back and hasattr(self._body, 'readinto'):
+            count = self._body.readinto(view)
+            self.bytes_read += count or 0
+            return count
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def iter_chunks(self, size=chunk_size):
+        chunk = self.read(size)
+        while chunk:
+            yield chunk
+            chunk = self.read(size)
+
+    def read_all(self, max_bytes=None):
+        chunks = []
+        total = 0
+        for chunk in self.iter_chunks():
+            total += len(chunk)
+            if max_bytes is not None and total > max_bytes:
+                self.close()
+                raise ResponseTooLarge("Response body is larger than %s bytes" % max_bytes)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def is_empty(self):
+        "True if the body has nothing left to read.  Reads ahead, but nothing is lost."
+        if not self._pushed_back:
+            self._pushed_back = self._counted(self._body.read(self.chunk_size))
+        return not self._pushed_back
+
+    def peek(self):
+        "The next chunk of the body, read ahead but left to be read"
+        self.is_empty()
+        return self._pushed_back
+
+    def _counted(self, data):
+        self.bytes_read += len(data)
+        return data
+
+    def discard(self, limit=65536):
+        """Reads and drops what is left of the body, so a pooled connection goes back to its pool, or
+        closes the body instead once more than limit bytes turn out to be left"""
+        self._pushed_back = ''
+        left = limit
+        while left >= 0:
+            chunk = self._counted(self._body.read(self.chunk_size))
+            if not chunk:
+                return
+            left -= len(chunk)
+        self.close()
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
@@ -0,0 +1,485 @@
+import unittest, time, zlib, gzip, threading, socket
+from StringIO import StringIO
+from rest_client import Client, SpooledBody, AdaptiveLimiter, LatencyCollector, Histogram, Response, HedgingPolicy, DecompressingStream, ResponseStream, ResponseTooLarge, ConnectionPool, ResponseCache, AsyncClient, EventLoop, Pending, gather, MetricsRegistry, metrics_app
+from stubserver import StubServer
+
+class ResponseStreamTest(unittest.TestCase):
+    def test_iter_chunks_yields_the_body_in_pieces(self):
+        stream = ResponseStream(StringIO('abcdefg'))
+        self.assertEquals(['abc', 'def', 'g'], list(stream.iter_chunks(3)))
+
+    def test_readinto_fills_a_reusable_buffer(self):
+        stream = ResponseStream(StringIO('abcdefg'))
+        buffer = bytearray(4)
+        self.assertEquals(4, stream.readinto(buffer))
+        self.assertEquals('abcd', str(buffer))
+        self.assertEquals(3, stream.readinto(buffer))
+        self.assertEquals('efg', str(buffer[:3]))
+        self.assertEquals(0, stream.readinto(buffer))
+
+    def test_read_all_refuses_bodies_over_max_bytes(self):
+        self.assertEquals('abcdefg', ResponseStream(StringIO('abcdefg')).read_all(max_bytes=7))
+        self.assertRaises(ResponseTooLarge, ResponseStream(StringIO('abcdefg')).read_all, 6)
+
+    def test_is_empty_loses_nothing_that_was_read_ahead(self):
+        stream = ResponseStream(StringIO('line1\nline2'))
+        self.assertFalse(stream.is_empty())
+        self.assertEquals(['line1\n', 'line2'], list(stream))
+        self.assertTrue(ResponseStream(StringIO('')).is_empty())
+
+def gzipped(data):
+    buffer = StringIO()
+    f = gzip.GzipFile(fileobj=buffer, mode='wb')
+    f.write(data)
+    f.close()
+    return buffer.getvalue()
+
+class DecompressingStreamTest(unittest.TestCase):
+    def test_gzip_bodies_are_inflated_a_piece_at_a_time(self):
+        stream = DecompressingStream(StringIO(gzipped('line\n' * 10000)), 'gzip')
+        self.assertEquals('line\n', stream.readline())
+        self.assertEquals('li', stream.read(2))
+        self.assertEquals('ne\n' + 'line\n' * 9998, stream.read())
+
+    def test_zlib_wrapped_and_raw_deflate_bodies_are_inflated(self):
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw_deflated = raw.compress('<root/>') + raw.flush()
+        self.assertEquals('<root/>', DecompressingStream(StringIO(zlib.compress('<root/>')), 'deflate').read())
+        self.assertEquals('<root/>', DecompressingStream(StringIO(raw_deflated), 'deflate').read())
+
+class HedgingPolicyTest(unittest.TestCase):
+    def slow_then_fast(self):
+        calls = []
+        def send():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return Response("/original", 200, {}, StringIO())
+            return Response("/hedge", 200, {}, StringIO())
+        return send
+
+    def test_a_hedge_is_sent_when_no_response_arrives_within_the_delay(self):
+        policy = HedgingPolicy(initial_delay=0.05, max_extra_load=1)
+        start = time.time()
+        self.assertEquals('/hedge', policy.execute(self.slow_then_fast()).url)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEquals((1, 1, 1), (policy.requests, policy.hedges_fired, policy.hedges_won))
+
+    def test_hedges_are_capped_by_max_extra_load(self):
+        policy = HedgingPolicy(initial_delay=0.05, max_extra_load=0)
+        self.assertEquals('/original', policy.execute(self.slow_then_fast()).url)
+        self.assertEquals((1, 0, 0), (policy.requests, policy.hedges_fired, policy.hedges_won))
+
+    def test_delay_is_the_percentile_of_observed_latencies(self):
+        policy = HedgingPolicy(percentile=90, min_samples=10)
+        self.assertEquals(policy.initial_delay, policy.delay())
+        for latency in range(1, 11):
+            policy._latencies.append(latency / 100.0)
+        self.assertEquals(0.1, policy.delay())
+
+class SpooledBodyTest(unittest.TestCase):
+    def test_bodies_up_to_the_threshold_are_kept_in_memory(self):
+        body = SpooledBody(StringIO('line1\nline2'), 100)
+        self.assertFalse(body.spilled)
+        self.assertEquals('line1\n', body.readline())
+        self.assertEquals('line2', body.read())
+
+    def test_bodies_past_the_threshold_are_read_back_from_a_memory_map(self):
+        body = SpooledBody(StringIO('record\n' * 20000), 1000)
+        self.assertTrue(body.spilled)
+        self.assertEquals(140000, len(body.buffer))
+        self.assertEquals('record\n', body.readline())
+        self.assertEquals(19999, len(list(ResponseStream(body))))
+        body.close()
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, keep_alive=True)
+        self.server.run()
+        self.pool = ConnectionPool()
+        self.client = Client("http://localhost:8998", pool=self.pool)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def test_connection_is_reused_once_the_body_has_been_read(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=3).and_return(mime_type="text/xml", content="<address/>")
+        for i in range(3):
+            self.assertEquals("<address/>", self.client.GET("/address/%s" % i).content.read())
+        self.assertEquals(1, self.pool.created)
+        self.assertEquals(2, self.pool.reused)
+
+    def test_connection_is_not_reused_while_a_body_is_unread(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=2).and_return(mime_type="text/xml", content="<address/>")
+        first = self.client.GET("/address/1")
+        second = self.client.GET("/address/2")
+        self.assertEquals("<address/>", first.content.read())
+        self.assertEquals("<address/>", second.content.read())
+        self.assertEquals(2, self.pool.created)
+
+    def test_spooled_bodies_hand_the_connection_back_before_they_are_read(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=2).and_return(mime_type="text/xml", content="<address/>")
+        client = Client("http://localhost:8998", pool=self.pool, spool_threshold=4)
+        first = client.GET("/address/1")
+        second = client.GET("/address/2")
+        self.assertEquals(1, self.pool.created)
+        self.assertTrue(first.content.read() == second.content.read() == "<address/>")
+
+    def test_idle_connections_past_the_idle_timeout_are_discarded(self):
+        self.pool.idle_timeout = 0.01
+        self.server.expect(method="GET", url="/address/\d+$", times=2).and_return(mime_type="text/xml", content="<address/>")
+        self.client.GET("/address/1").content.read()
+        time.sleep(0.05)
+        self.client.GET("/address/2").content.read()
+        self.assertEquals(2, self.pool.created)
+        self.assertEquals(0, self.pool.reused)
+
+    def test_a_dropped_response_hands_its_connection_back(self):
+        self.server.expect(method="GET", url="/address/\d+$").and_return(mime_type="text/xml", content="<address/>")
+        response = self.client.GET("/address/1")
+        del response
+        self.assertEquals(0, self.pool._in_use[('http', 'localhost:8998')])
+
+    def test_discarding_the_rest_of_a_body_lets_the_connection_be_reused(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=2).and_return(mime_type="text/xml", content="<address/>")
+        ResponseStream.wrap(self.client.GET("/address/1").content).discard()
+        self.client.GET("/address/2").content.read()
+        self.assertEquals(1, self.pool.reused)
+
+    def test_a_response_without_a_body_hands_its_connection_back_straight_away(self):
+        self.server.expect(method="HEAD", url="/address/\d+$", times=3).and_return(mime_type="text/xml", headers={'X-Total-Count': '3'})
+        responses = [self.client.HEAD("/address/%s" % i) for i in range(3)]
+        self.assertEquals((1, 2), (self.pool.created, self.pool.reused))
+        self.assertEquals(0, self.pool._in_use[('http', 'localhost:8998')])
+
+    def test_only_requests_that_change_nothing_are_resent_on_a_dropped_connection(self):
+        class Dropped(object):
+            sock = None
+            def __init__(self):
+                self.requests = []
+            def request(self, method, path, payload, headers):
+                self.requests.append(method)
+                if len(self.requests) == 1:
+                    raise socket.error("connection reset")
+            def getresponse(self):
+                class response:
+                    status = 200
+                    msg = {}
+                    will_close = False
+                    def isclosed(self):
+                        return True
+                return response()
+            def close(self):
+                pass
+        self.pool._is_usable = lambda conn, released_at: True
+        for method, sent in (('GET', ['GET', 'GET']), ('POST', ['POST'])):
+            conn = Dropped()
+            self.pool._idle[('http', 'localhost:8998')] = [(conn, time.time())]
+            try:
+                self.pool.urlopen(method, "http://localhost:8998/address/1")
+            except socket.error:
+                pass
+            self.assertEquals(sent, conn.requests)
+
+    def test_lines_can_be_read_from_a_pooled_response(self):
+        self.server.expect(method="GET", url="/simple$").and_return(content='{"field1": "hello"}\n{"field1": "goodbye"}')
+        lines = self.client.GET("/simple").content.readlines()
+        self.assertEquals(['{"field1": "hello"}\n', '{"field1": "goodbye"}'], lines)
+
+class UnpooledClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998)
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_client_without_a_pool_opens_a_connection_per_request(self):
+        self.server.expect(method="GET", url="/address/\d+$").and_return(mime_type="text/xml", content="<address/>")
+        response = Client("http://localhost:8998", pool=None).GET("/address/1")
+        self.assertEquals(200, response.response_code)
+        self.assertEquals("<address/>", response.content.read())
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, keep_alive=True)
+        self.server.run()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def test_gzip_encoded_responses_are_decoded_when_decompress_is_on(self):
+        self.server.expect(method="GET", url="/address/1$").and_return(content=gzipped("<address/>"), headers={'Content-Encoding': 'gzip'})
+        response = Client("http://localhost:8998", pool=self.pool, decompress=True).GET("/address/1")
+        self.assertEquals("<address/>", response.content.read())
+        self.assertFalse('content-encoding' in response.headers)
+
+    def test_encoded_responses_are_left_alone_when_decompress_is_off(self):
+        body = gzipped("<address/>")
+        self.server.expect(method="GET", url="/address/1$").and_return(content=body, headers={'Content-Encoding': 'gzip'})
+        response = Client("http://localhost:8998", pool=self.pool).GET("/address/1")
+        self.assertEquals(body, response.content.read())
+
+class RecordingListener(object):
+    def __init__(self):
+        self.events = []
+
+    def pre_request(self, timing):
+        self.events.append('pre_request')
+
+    def connected(self, timing):
+        self.events.append('connected')
+
+    def first_byte(self, timing):
+        self.events.append('first_byte')
+
+    def complete(self, timing):
+        self.events.append('complete')
+        self.timing = timing
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, keep_alive=True)
+        self.server.run()
+        self.pool = ConnectionPool()
+        self.client = Client("http://localhost:8998", pool=self.pool)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def test_listeners_are_told_how_a_request_progresses(self):
+        self.server.expect(method="GET", url="/address/1$").and_return(content="<address/>")
+        listener = RecordingListener()
+        self.client.add_listener(listener)
+        self.client.GET("/address/1").content.read()
+        self.assertEquals(['pre_request', 'connected', 'first_byte', 'complete'], listener.events)
+        timing = listener.timing
+        self.assertEquals(10, timing.bytes_received)
+        self.assertEquals(200, timing.status)
+        self.assertTrue(timing.started <= timing.connected_at <= timing.first_byte_at <= timing.completed_at)
+
+    def test_latency_collector_keeps_a_histogram_per_host(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=2).and_return(content="<address/>")
+        collector = LatencyCollector()
+        self.client.add_listener(collector)
+        self.client.GET("/address/1").content.read()
+        self.client.GET("/address/2").content.read()
+        self.assertEquals(2, collector.by_host['localhost:8998']['total'].count)
+
+    def test_histogram_percentile_is_the_bound_of_its_bucket(self):
+        histogram = Histogram(buckets=(1, 2, 3))
+        for value in (0.5, 1.5, 1.7, 2.5):
+            histogram.observe(value)
+        self.assertEquals(2, histogram.percentile(50))
+        self.assertEquals(3, histogram.percentile(100))
+        self.assertEquals(6.2, histogram.sum)
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_requests_over_the_limit_queue_until_one_is_released(self):
+        limiter = AdaptiveLimiter(initial_limit=1)
+        started = []
+        limiter.acquire_async('host', lambda: started.append(1))
+        limiter.acquire_async('host', lambda: started.append(2))
+        self.assertEquals([1], started)
+        self.assertEquals(1, limiter.stats('host')['queued'])
+        limiter.release('host', 0.1)
+        self.assertEquals([1, 2], started)
+        self.assertEquals(1, limiter.stats('host')['waits'])
+
+    def test_limit_grows_while_latency_holds_and_backs_off_on_failure(self):
+        limiter = AdaptiveLimiter(initial_limit=4, backoff=0.5)
+        for i in range(20):
+            limiter.acquire('host')
+            limiter.release('host', 0.1)
+        grown = limiter.stats('host')['limit']
+        self.assertTrue(grown > 4)
+        limiter.acquire('host')
+        limiter.release('host', 0.1, failed=True)
+        self.assertEquals(int(grown * 0.5), limiter.stats('host')['limit'])
+
+    def test_slow_responses_count_against_the_limit(self):
+        limiter = AdaptiveLimiter(initial_limit=10, backoff=0.5, tolerance=2.0)
+        limiter.acquire('host')
+        limiter.release('host', 0.1)
+        limiter.acquire('host')
+        limiter.release('host', 0.5)
+        self.assertEquals(5, limiter.stats('host')['limit'])
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, keep_alive=True)
+        self.server.run()
+        self.pool = ConnectionPool()
+        self.cache = ResponseCache()
+        self.client = Client("http://localhost:8998", pool=self.pool, cache=self.cache)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def test_fresh_responses_are_served_from_the_cache(self):
+        self.server.expect(method="GET", url="/address/1$").and_return(content="<address/>", headers={'Cache-Control': 'max-age=60'})
+        self.assertEquals("<address/>", self.client.GET("/address/1").content.read())
+        self.assertEquals("<address/>", self.client.GET("/address/1").content.read())
+        self.assertEquals((1, 1, 0), (self.cache.misses, self.cache.hits, self.cache.revalidations))
+
+    def test_stale_responses_are_revalidated_and_served_from_the_cache_on_304(self):
+        self.server.expect(method="GET", url="/address/1$").and_return(content="<address/>", headers={'ETag': '"v1"'})
+        self.server.expect(method="GET", url="/address/1$").and_return(reply_code=304)
+        self.client.GET("/address/1").content.read()
+        response = self.client.GET("/address/1")
+        self.assertEquals(200, response.response_code)
+        self.assertEquals("<address/>", response.content.read())
+        self.assertEquals((1, 0, 1), (self.cache.misses, self.cache.hits, self.cache.revalidations))
+
+    def test_responses_without_validators_or_max_age_are_not_cached(self):
+        self.server.expect(method="GET", url="/address/1$", times=2).and_return(content="<address/>")
+        self.client.GET("/address/1").content.read()
+        self.client.GET("/address/1").content.read()
+        self.assertEquals(2, self.cache.misses)
+
+    def test_least_recently_used_entries_are_evicted_to_stay_under_max_bytes(self):
+        cache = ResponseCache(max_bytes=250)
+        headers = {'etag': '"v1"'}
+        cache.store('a', 200, headers, 'a' * 100)
+        cache.store('b', 200, headers, 'b' * 100)
+        cache.lookup('a')
+        cache.store('c', 200, headers, 'c' * 100)
+        self.assertTrue(cache.lookup('a') is not None)
+        self.assertTrue(cache.lookup('b') is None)
+        self.assertTrue(cache.size <= 250)
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(8998, keep_alive=True)
+        self.server.run()
+        self.loop = EventLoop()
+        self.client = AsyncClient("http://localhost:8998", loop=self.loop)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_many_requests_are_in_flight_on_one_loop(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=20).and_return(mime_type="text/xml", content="<address/>")
+        pendings = [self.client.GET("/address/%s" % i) for i in range(20)]
+        self.assertEquals(20, len(self.loop.map))
+        responses = gather(pendings).result()
+        self.assertEquals([200] * 20, [response.response_code for response in responses])
+        self.assertEquals("<address/>", responses[0].content.read())
+
+    def test_requests_wait_on_the_limiter(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=5).and_return(mime_type="text/xml", content="<address/>")
+        limiter = AdaptiveLimiter(initial_limit=2)
+        client = AsyncClient("http://localhost:8998", loop=self.loop, limiter=limiter)
+        pendings = [client.GET("/address/%s" % i) for i in range(5)]
+        self.assertEquals(2, len(self.loop.map))
+        self.assertEquals(3, limiter.stats('localhost:8998')['queued'])
+        self.assertEquals(5, len(gather(pendings).result()))
+        self.assertEquals(0, limiter.stats('localhost:8998')['in_flight'])
+
+    def test_a_request_queued_behind_a_blocking_caller_is_started_by_the_thread_driving_the_loop(self):
+        self.server.expect(method="GET", url="/address/\d+$").and_return(mime_type="text/xml", content="<address/>")
+        limiter = AdaptiveLimiter(initial_limit=1)
+        client = AsyncClient("http://localhost:8998", loop=self.loop, limiter=limiter)
+        limiter.acquire('localhost:8998')
+        pending = client.GET("/address/1")
+        releaser = threading.Thread(target=limiter.release, args=('localhost:8998', 0.1))
+        releaser.start()
+        releaser.join()
+        self.assertEquals({}, self.loop.map)
+        self.assertEquals(200, pending.result().response_code)
+
+    def test_waiting_on_a_queued_request_waits_for_the_limiter(self):
+        self.server.expect(method="GET", url="/address/\d+$").and_return(mime_type="text/xml", content="<address/>")
+        limiter = AdaptiveLimiter(initial_limit=1)
+        client = AsyncClient("http://localhost:8998", loop=self.loop, limiter=limiter)
+        limiter.acquire('localhost:8998')
+        pending = client.GET("/address/1")
+        threading.Timer(0.2, limiter.release, args=('localhost:8998', 0.1)).start()
+        self.assertEquals(200, pending.result().response_code)
+        self.assertEquals(0, limiter.stats('localhost:8998')['in_flight'])
+
+    def test_a_reply_larger_than_the_spool_threshold_is_read_back_from_disk(self):
+        self.server.expect(method="GET", url="/address/\d+$").and_return(mime_type="text/xml", content="<address>%s</address>" % ("x" * 1000))
+        client = AsyncClient("http://localhost:8998", loop=self.loop, spool_threshold=100)
+        self.assertEquals("<address>%s</address>" % ("x" * 1000), client.GET("/address/1").result().content.read())
+
+    def test_threads_waiting_on_the_same_loop_take_turns_driving_it(self):
+        self.server.expect(method="GET", url="/address/\d+$", times=10).and_return(mime_type="text/xml", content="<address/>")
+        pendings = [self.client.GET("/address/%s" % i) for i in range(10)]
+        codes = []
+        def wait(pending):
+            codes.append(pending.result().response_code)
+        waiters = [threading.Thread(target=wait, args=(pending,)) for pending in pendings]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+        self.assertEquals([200] * 10, codes)
+
+    def test_then_chains_over_the_result(self):
+        self.server.expect(method="GET", url="/simple$").and_return(content='hello')
+        pending = self.client.GET("/simple").then(lambda response: response.content.read().upper())
+        self.assertEquals("HELLO", pending.result())
+
+    def test_failures_are_raised_from_result(self):
+        pending = Pending.completed(None, self.loop).then(lambda value: 1 / 0)
+        self.assertRaises(ZeroDivisionError, pending.result)
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_counters_and_histograms_render_in_the_prometheus_text_format(self):
+        registry = MetricsRegistry()
+        registry.client_requests.inc(('GET', 'foo.com', '200'), 2)
+        registry.client_seconds.observe(('GET', 'foo.com'), 0.003)
+        registry.client_seconds.observe(('GET', 'foo.com'), 20)
+        text = registry.render()
+        self.assertTrue('# TYPE rest_client_requests_total counter\nrest_client_requests_total{method="GET",host="foo.com",status="200"} 2\n' in text)
+        self.assertTrue('rest_client_request_seconds_bucket{method="GET",host="foo.com",le="0.001"} 0\n' in text)
+        self.assertTrue('rest_client_request_seconds_bucket{method="GET",host="foo.com",le="0.005"} 1\n' in text)
+        self.assertTrue('rest_client_request_seconds_bucket{method="GET",host="foo.com",le="+Inf"} 2\n' in text)
+        self.assertTrue('rest_client_request_seconds_count{method="GET",host="foo.com"} 2\n' in text)
+
+    def test_counts_recorded_on_other_threads_are_summed(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('jobs_total', 'Jobs', ('queue',))
+        threads = [threading.Thread(target=lambda: [counter.inc(('a',)) for i in range(1000)]) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals({('a',): 4000}, counter.collect())
+
+    def test_the_counts_of_finished_threads_are_kept_without_their_shards(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('jobs_total', 'Jobs')
+        for i in range(50):
+            thread = threading.Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        self.assertEquals({(): 50}, counter.collect())
+        self.assertTrue(len(counter._shards) <= 1)
+
+    def test_client_requests_are_counted_and_served_to_scrapers(self):
+        server = StubServer(8998)
+        server.run()
+        pool = ConnectionPool()
+        try:
+            server.expect(method="GET", url="/metered$").and_return(content="hello")
+            registry = MetricsRegistry()
+            Client("http://localhost:8998", pool=pool, metrics=registry).GET("/metered").content.read()
+        finally:
+            pool.clear()
+            server.stop()
+        self.assertEquals({('GET', 'localhost:8998', '200'): 1}, registry.client_requests.collect())
+        started = []
+        body = ''.join(metrics_app(registry)({}, lambda status, headers: started.append((status, dict(headers)))))
+        self.assertEquals('200 OK', started[0][0])
+        self.assertEquals('text/plain; version=0.0.4', started[0][1]['Content-Type'])
+        self.assertTrue('rest_client_requests_total{method="GET",host="localhost:8998",status="200"} 1\n' in body)
+
+if __name__=='__main__':
+    unittest.main()
@@ -25,7 +25,7 @@ The views and conclusions contained in the software and documentation are those
 authors and should not be interpreted as representing official policies, either expressed
 or implied, of the FreeBSD Project.
 """
-import BaseHTTPServer, cgi, threading, re, urllib, httplib
+import BaseHTTPServer, SocketServer, cgi, threading, re, urllib, httplib
 import unittest, urllib, urllib2, time
 from unittest import TestCase
 import sys
@@ -64,20 +64,32 @@ else:
     HTTPServer = BaseHTTPServer.HTTPServer
 
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    """Keep-alive connections hold on to their handler, so each one gets a thread of its own"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
 class StubServer(object):
 
     _expectations = []
 
-    def __init__(self, port):
+    def __init__(self, port, keep_alive=False):
         self.port = port
+        self.keep_alive = keep_alive
 
     def run(self):
         server_address = ('localhost', self.port)
-        self.httpd = HTTPServer(server_address, StubResponse)
+        if self.keep_alive:
+            self.httpd = ThreadingHTTPServer(server_address, KeepAliveStubResponse)
+        else:
+            self.httpd = HTTPServer(server_address, StubResponse)
         t = threading.Thread(target=self._run)
         t.start()
 
     def stop(self):
+        if hasattr(self.httpd, 'shutdown'):
+            self.httpd.shutdown()
         self.httpd.server_close()
         self.verify()
 
@@ -89,32 +101,40 @@ class StubServer(object):
 
     def verify(self):
         failures = []
-        for expectation in self._expectations:
+        for expectation in list(self._expectations):
             if not expectation.satisfied:
                 failures.append(str(expectation))
             self._expectations.remove(expectation)
         if failures:
             raise Exception("Unsatisfied expectations:\n" + "\n".join(failures))
 
-    def expect(self, method="GET", url="^UrlRegExpMatcher$", data=None, data_capture={}, file_content=None):
-        expected = Expectation(method, url, data, data_capture)
+    def expect(self, method="GET", url="^UrlRegExpMatcher$", data=None, data_capture={}, file_content=None, times=1):
+        """times is how often the expectation may be matched, None for any number of times"""
+        expected = Expectation(method, url, data, data_capture, times)
         self._expectations.append(expected)
         return expected
 
 class Expectation(object):
-    def __init__(self, method, url, data, data_capture):
+    def __init__(self, method, url, data, data_capture, times=1):
         self.method = method
         self.url = url
         self.data = data
         self.data_capture = data_capture
+        self.times = times
+        self.calls = 0
         self.satisfied = False
 
-    def and_return(self, mime_type="text/html", reply_code=200, content="", file_content=None):
+    def matches(self, method, path):
+        exhausted = self.times is not None and self.calls >= self.times
+        return self.method == method and re.search(self.url, path) and not exhausted
+
+    def and_return(self, mime_type="text/html", reply_code=200, content="", file_content=None, headers={}):
         if file_content:
             f = open(file_content, "r")
             content = f.read()
             f.close()
         self.response = (reply_code, mime_type, content)
+        self.headers = headers
 
     def __str__(self):
         return self.method + ":" + self.url
@@ -208,17 +228,35 @@ class StubResponse(BaseHTTPServer.BaseHTTPRequestHandler):
         if self.path == "/__shutdown":
             self.send_response(200, "Python")
         for exp in self.expected:
-            if exp.method == method and re.search(exp.url, self.path) and not exp.satisfied:
+            if exp.matches(method, self.path):
                 self.send_response(exp.response[0], "Python")
                 self.send_header("Content-Type", exp.response[1])
+                for name, value in exp.headers.items():
+                    self.send_header(name, value)
+                self._send_extra_headers(exp)
                 self.end_headers()
                 self.wfile.write(exp.response[2])
                 data = self._get_data()
+                exp.calls += 1
                 exp.satisfied = True
                 exp.data_capture["body"] = data
                 break
         self.wfile.flush()
 
+    def _send_extra_headers(self, exp):
+        pass
+
+
+class KeepAliveStubResponse(StubResponse):
+    """Answers with HTTP/1.1 and a Content-Length, so clients can reuse the connection"""
+    protocol_version = "HTTP/1.1"
+    # Buffer the response and flush it in one go, otherwise Nagle stalls every reply on a reused connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _send_extra_headers(self, exp):
+        self.send_header("Content-Length", str(len(exp.response[2])))
+
 
 class WebTest(TestCase):
 
@@ -31,9 +31,10 @@ to xml, and specifying finders that map to a remote REST service.  For parsing X
 XPath expressions, xml_models attempts to use lxml if it is available.  If not, it 
 uses pyxml_xpath.  Better performance will be gained by installing lxml."""
 
-import re, datetime, time
+import re, datetime, time, copy
 import xpath_twister as xpath
 from common_models import *
+from common_models.common_models import _timed_parse, _timed_records, _configure_manager
 
 
 class XmlValidationError(Exception):
@@ -183,12 +184,13 @@ class ModelBase(type):
         for field_name in xml_fields:
             setattr(cls, field_name, cls._get_xpath(field_name, attrs[field_name]))
             attrs[field_name]._name = field_name
+        cls._simple_fields = [attrs[field_name] for field_name in sorted(xml_fields)
+                              if not isinstance(attrs[field_name], (Collection, OneToOneField))]
         if attrs.has_key("finders"):
             setattr(cls, "objects", ModelManager(cls, attrs["finders"]))
         else:
             setattr(cls, "objects", ModelManager(cls, {}))
-        if attrs.has_key("headers"):
-            setattr(cls.objects, "headers", attrs["headers"])
+        _configure_manager(cls.objects, attrs)
     
     def _get_xpath(cls, field_name, field_impl):
         return property(fget=lambda cls: cls._parse_field(field_impl), fset=lambda cls, value : cls._set_value(field_impl, value))
@@ -211,12 +213,56 @@ class Model:
         addresses = xml_models.CollectionField(Address, xpath="/Person/Addresses/Address")
         date_of_birth = xml_models.DateField(xpath="/Person/@DateOfBirth", date_format="%d-%m-%Y")
     """
+    _frozen = False
+
     def __init__(self, xml=None, dom=None):
         self._xml = xml
         self._dom = dom
         self._cache = {}
         self.validate_on_load()
 
+    @classmethod
+    def from_stream(cls, stream):
+        "Builds the model from a file like object, parsing it as it is read"
+        return cls(dom=_timed_parse(cls, xpath.domify_stream, stream))
+
+    @classmethod
+    def _records(cls, stream, record_path=None):
+        """Yields a parsed document for each record of a collection read from stream, ready to build a model on,
+        reporting the time taken to parse each into the manager's metrics"""
+        records = xpath.iter_records(stream, record_path)
+        if getattr(cls.objects, 'metrics', None) is None:
+            return records
+        return _timed_records(cls, records)
+
+    @classmethod
+    def _count_records(cls, stream, record_path=None):
+        return xpath.count_records(stream, record_path)
+
+    @classmethod
+    def _raw_records(cls, stream, record_path=None):
+        return xpath.iter_raw_records(stream, record_path)
+
+    @classmethod
+    def _hydrate(cls, xml):
+        "A model on the record xml, parsed now rather than when a field is first read"
+        model = cls(xml=xml)
+        model._get_xml()
+        return model
+
+    @classmethod
+    def _field_values(cls, xml):
+        "The values of the model's fields, other than collections and nested models, read from the record xml"
+        model = cls(xml=xml)
+        return tuple([model._parse_field(field) for field in cls._simple_fields])
+
+    @classmethod
+    def _from_field_values(cls, xml, values):
+        "A model on the record xml with the values _field_values read from it, so it is parsed only if other fields are read"
+        model = cls(xml=xml)
+        model._cache.update(zip(cls._simple_fields, values))
+        return model
+
     """Override on your model to perform validation when the XML data is first passed in. This is to ensure the xml returned
        conforms to the validation rules.  We use this because some records are no use to us if they don't contain certain
        data."""
@@ -226,14 +272,31 @@ class Model:
     def _get_xml(self):
         if self._dom is None:
             try :
-                self._dom = xpath.domify(self._xml or '<x/>')
+                self._dom = _timed_parse(self.__class__, xpath.domify, self._xml or '<x/>')
             except Exception, e:
                 print self._xml
                 print str(e)
                 raise e
         return self._dom
         
+    def _clone(self):
+        "A copy of this model that shares no document with it"
+        dom = None
+        if self._dom is not None:
+            dom = copy.deepcopy(self._dom)
+        return type(self)(xml=self._xml, dom=dom)
+
+    def _freeze(self, immutable):
+        "Collection and OneToOneField sub-models are part of their parent, so they are made immutable along with it"
+        self._frozen = immutable
+        for value in self._cache.values():
+            _set_immutable(value, immutable)
+
+    _immutable = property(lambda self: self._frozen, _freeze)
+
     def _set_value(self, field, value):
+        if self._immutable:
+            raise ImmutableModelError("%s is shared and cannot be changed" % type(self).__name__)
         self._cache[field] = value
         
     def _parse_field(self, field):
@@ -241,8 +304,19 @@ class Model:
             namespace = None
             if hasattr(self, 'namespace'):
                 namespace = self.namespace
-            self._cache[field] = field.parse(self._get_xml(), namespace)
+            value = self._cache[field] = field.parse(self._get_xml(), namespace)
+            if self._frozen:
+                _set_immutable(value, True)
         return self._cache[field]
 
+def _set_immutable(value, immutable):
+    "Sets the immutability of value, if it is a model, or of the models in it, if it is a list"
+    if isinstance(value, Model):
+        value._immutable = immutable
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, Model):
+                item._immutable = immutable
+
 
 
@@ -26,8 +26,9 @@ authors and should not be interpreted as representing official policies, either
 or implied, of the FreeBSD Project.
 """
 
-import unittest
-from xml.dom import minidom
+import unittest, copy, re
+from xml.dom import minidom, pulldom
+from xml.parsers import expat
 import xpath
 
 class MultipleNodesReturnedException(Exception):
@@ -88,6 +89,161 @@ def domify(xml):
     else:
         return minidom.parseString(xml)
 
+def domify_stream(stream):
+    "As domify, but parses incrementally from a file like object"
+    if lxml_available:
+        return objectify.parse(stream).getroot()
+    else:
+        return minidom.parse(stream)
+
+def iter_records(stream, record_path=None):
+    """Parses a collection incrementally from a file like object, yielding a document, as domify would give, for
+    each record.  Records are the elements at record_path, e.g. '/Envelope/Body/Items/Item', or named record_path
+    at any depth when it is just a name, or by default the children of the root named as the first of them.
+    Everything read before the current record is let go, so memory stays bounded however long the collection."""
+    if lxml_available:
+        return _lxml_records(stream, _record_test(record_path))
+    else:
+        return _pydom_records(stream, _record_test(record_path))
+
+def count_records(stream, record_path=None):
+    "Counts the records iter_records would give, without building them"
+    is_record = _record_test(record_path)
+    state = {'names': [], 'in_record': 0, 'count': 0}
+    def start(name, attrs):
+        state['names'].append(name.split(' ')[-1])
+        if state['in_record']:
+            state['in_record'] += 1
+        elif is_record(state['names']):
+            state['in_record'] = 1
+            state['count'] += 1
+    def end(name):
+        state['names'].pop()
+        state['in_record'] = max(state['in_record'] - 1, 0)
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.ParseFile(stream)
+    return state['count']
+
+def iter_raw_records(stream, record_path=None, chunk_size=65536):
+    """As iter_records, but yields the text of each record, carrying the namespace declarations in scope where
+    it was found, to be parsed elsewhere.  Only the record being read is held in memory."""
+    is_record = _record_test(record_path)
+    parser = expat.ParserCreate(namespace_separator=' ')
+    state = {'names': [], 'scopes': [], 'declared': [], 'start': None, 'depth': None, 'inherited': None}
+    found = []
+    def declare(prefix, uri):
+        state['declared'].append((prefix, uri))
+    def start(name, attrs):
+        state['names'].append(name.split(' ')[-1])
+        state['scopes'].append(state['declared'])
+        if state['start'] is None and is_record(state['names']):
+            own = dict(state['declared'])
+            inherited = {}
+            for scope in state['scopes'][:-1]:
+                inherited.update(scope)
+            state['start'], state['depth'] = parser.CurrentByteIndex, len(state['names'])
+            state['inherited'] = [(prefix, uri) for prefix, uri in sorted(inherited.items()) if prefix not in own]
+        state['declared'] = []
+    def end(name):
+        if state['depth'] == len(state['names']):
+            found.append((state['start'], parser.CurrentByteIndex, state['inherited']))
+            state['start'] = state['depth'] = None
+        state['names'].pop()
+        state['scopes'].pop()
+    parser.StartNamespaceDeclHandler = declare
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    buffer, offset = '', 0
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        parser.Parse(chunk, not chunk)
+        for start_index, end_index, inherited in found:
+            yield _raw_record(buffer, start_index - offset, end_index - offset, inherited)
+        del found[:]
+        if not chunk:
+            return
+        if state['start'] is None:
+            # The next record's start tag may have been read in part, but cannot begin before the last '<'
+            keep_from = max(buffer.rfind('<'), 0) + offset
+        else:
+            keep_from = state['start']
+        buffer, offset = buffer[keep_from - offset:], keep_from
+
+_tag = re.compile(r"""<[^"'>]*(?:(?:"[^"]*"|'[^']*')[^"'>]*)*>""")
+
+def _raw_record(buffer, start, end, inherited):
+    "The text of the element from the tag at start to the tag at end, with the inherited namespaces declared on it"
+    start_tag = _tag.match(buffer, start).group()
+    if start_tag.endswith('/>'):
+        record = start_tag
+    else:
+        record = buffer[start:_tag.match(buffer, end).end()]
+    if not inherited:
+        return record
+    name_end = re.compile(r'[\s/>]').search(record, 1).start()
+    declarations = ''.join([' xmlns%s="%s"' % (prefix and ':' + prefix.encode('utf-8') or '', uri.encode('utf-8').replace('"', '&quot;'))
+                            for prefix, uri in inherited])
+    return record[:name_end] + declarations + record[name_end:]
+
+def _record_test(record_path):
+    "A test of the names of the open elements, outermost first, that is True when the innermost is a record"
+    if record_path is None:
+        first = []
+        def is_record(names):
+            if len(names) != 2:
+                return False
+            if not first:
+                first.append(names[1])
+            return names[1] == first[0]
+        return is_record
+    if record_path.startswith('/'):
+        path = record_path.strip('/').split('/')
+        return lambda names: names == path
+    return lambda names: names[-1] == record_path
+
+def _local_name(tag):
+    return tag.split('}')[-1]
+
+def _lxml_records(stream, is_record):
+    names = []
+    record_depth = None
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            names.append(_local_name(elem.tag))
+            if record_depth is None and is_record(names):
+                record_depth = len(names)
+            continue
+        if record_depth == len(names):
+            # A copy is the root of a document of its own, which absolute xpaths are evaluated against
+            yield copy.deepcopy(elem)
+            record_depth = None
+        names.pop()
+        parent = elem.getparent()
+        if record_depth is None and parent is not None:
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+def _pydom_records(stream, is_record):
+    events = pulldom.parse(stream)
+    names = []
+    for event, node in events:
+        if event == pulldom.START_ELEMENT:
+            names.append(node.localName or node.tagName)
+            if is_record(names):
+                events.expandNode(node)
+                # Text read across chunks arrives as several nodes, which xpath matches would see only the first of
+                node.normalize()
+                names.pop()
+                document = minidom.Document()
+                document.appendChild(node)
+                yield document
+        elif event == pulldom.END_ELEMENT:
+            names.pop()
+
 def _pydom_xpath_all(xml, expression, namespace):
     nodelist = xpath.find(expression, xml, default_namespace=namespace)
     return [fragment.toxml() for fragment in nodelist]
@@ -34,6 +34,7 @@ import xml_models.xpath_twister as xpath
 import rest_client
 from mock import patch
 from StringIO import StringIO
+from xml.etree import ElementTree as et
 from stubserver import StubServer
 
 class Address(Model):
@@ -236,6 +237,25 @@ class XmlModelsTest(unittest.TestCase):
         self.assertEquals(2, count)
         self.assertTrue(mock_get.called)
         
+    @patch.object(et, "tostring")
+    @patch.object(rest_client.Client, "GET")
+    def test_count_reads_records_without_serialising_them(self, mock_get, mock_tostring):
+        class t:
+            content = StringIO("<elems><root><root>nested</root></root><root/><other/></elems>")
+        mock_get.return_value = t()
+        self.assertEquals(2, Simple.objects.filter(field1="baz").count())
+        self.assertFalse(mock_tostring.called)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_exists_stops_at_the_first_record(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><field1>hello</field1></root><root><field1>goodbye")
+            response_code = 200
+        mock_get.return_value = t()
+        self.assertTrue(Simple.objects.filter(field1="baz").exists())
+        t.content = StringIO("<elems></elems>")
+        self.assertFalse(Simple.objects.filter(field1="baz").exists())
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_queries_rest_service_when_getting_for_a_registered_finder(self, mock_get):
         class t:
@@ -318,6 +338,37 @@ class XmlModelsTest(unittest.TestCase):
         self.assertEquals("hello", results[0].field1)
         self.assertEquals("goodbye", results[1].field1)
         
+    @patch.object(xpath, "domify")
+    @patch.object(et, "tostring")
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_builds_models_on_records_without_parsing_them_again(self, mock_get, mock_tostring, mock_domify):
+        class t:
+            content = StringIO("<elems><root><field1>hello</field1></root><other/><root><field1>goodbye</field1></root></elems>")
+        mock_get.return_value = t()
+        self.assertEquals(["hello", "goodbye"], [mod.field1 for mod in Simple.objects.filter(field1="baz")])
+        self.assertFalse(mock_tostring.called)
+        self.assertFalse(mock_domify.called)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_manager_streams_records_from_the_record_path(self, mock_get):
+        class Item(Model):
+            name = CharField(xpath='/Item/name')
+            finders = { (name,): "http://foo.com/items/%s" }
+            record_path = '/Envelope/Body/Items/Item'
+        class t:
+            content = StringIO("<Envelope><Header><Item><name>header</name></Item></Header><Body><Items>"
+                               "<Item><name>hello</name></Item><Item><name>goodbye</name></Item></Items></Body></Envelope>")
+        mock_get.return_value = t()
+        self.assertEquals(["hello", "goodbye"], [item.name for item in Item.objects.filter(name="baz")])
+        t.content = StringIO(t.content.getvalue())
+        self.assertEquals(2, Item.objects.filter(name="baz").count())
+
+    def test_raw_records_carry_the_namespaces_declared_around_them(self):
+        feed = '<items xmlns="urn:i" xmlns:p="urn:p"><item a=">"><p:name>one</p:name></item><item/></items>'
+        for chunk_size in (1, 65536):
+            self.assertEquals(['<item xmlns="urn:i" xmlns:p="urn:p" a=">"><p:name>one</p:name></item>', '<item xmlns="urn:i" xmlns:p="urn:p"/>'],
+                              list(xpath.iter_raw_records(StringIO(feed), chunk_size=chunk_size)))
+
     @patch.object(rest_client.Client, "GET")
     def test_manager_returns_iterator_for_collection_of_results_from_custom_query(self, mock_get):
         class t:
@@ -376,6 +427,57 @@ class XmlModelsTest(unittest.TestCase):
         except SesameStreetCharacter:
             pass
 
+    def test_clone_copies_the_document_of_a_model(self):
+        original = MyModel(dom=xpath.domify('<root><kiddie><value>Rowlf</value></kiddie></root>'))
+        clone = original._clone()
+        self.assertEquals('Rowlf', clone.muppet_name)
+        self.assertFalse(clone._dom is original._dom)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_shared_instances_cannot_be_changed_through_their_sub_models(self, mock_get):
+        class Shared(Model):
+            muppet_name = CharField(xpath='/root/kiddie/value')
+            muppet_addresses = Collection(Address, xpath='/root/kiddie/address')
+            muppet_home = OneToOneField(Address, xpath='/root/kiddie/address')
+            finders = { (muppet_name,): "http://foo.com/shared/%s" }
+            instance_cache = InstanceCache(share_instances=True)
+        mock_get.side_effect = lambda url, headers={}: type('t', (), {'content': StringIO('<root><kiddie><value>Rowlf</value><address><street>Sesame</street></address></kiddie></root>'), 'response_code': 200})()
+        shared = Shared.objects.get(muppet_name='Rowlf')
+        self.assertRaises(ImmutableModelError, setattr, shared.muppet_addresses[0], 'street', 'Hacked')
+        self.assertRaises(ImmutableModelError, setattr, shared.muppet_home, 'street', 'Hacked')
+        self.assertEquals('Sesame', Shared.objects.get(muppet_name='Rowlf').muppet_addresses[0].street)
+        address = shared._clone().muppet_addresses[0]
+        address.street = 'Changed'
+        self.assertEquals('Changed', address.street)
+
+    @patch.object(rest_client.Client, "GET")
+    def test_iterated_records_report_their_parse_time_into_the_metrics_registry(self, mock_get):
+        class t:
+            content = StringIO("<elems><root><field1>a</field1></root><root><field1>b</field1></root></elems>")
+            response_code = 200
+        mock_get.return_value = t()
+        registry = rest_client.MetricsRegistry()
+        Simple.objects.metrics = registry
+        try:
+            self.assertEquals(['a', 'b'], [model.field1 for model in Simple.objects.filter(field1="baz")])
+        finally:
+            Simple.objects.metrics = None
+        self.assertEquals(2, sum(registry.parse_seconds.collect()[('Simple',)][0]))
+
+    def test_clone_keeps_the_document_of_a_record_with_no_child_elements(self):
+        class Item(Model):
+            id = CharField(xpath='/Item/@id')
+            name = CharField(xpath='/Item')
+        clone = Item(dom=xpath.domify('<Item id="7">seven</Item>'))._clone()
+        self.assertEquals(('7', 'seven'), (clone.id, clone.name))
+
+    def test_hedging_policy_specified_on_model_is_used_by_the_query_manager_client(self):
+        policy = rest_client.HedgingPolicy()
+        class Hedged(Model):
+            field1 = CharField(xpath='/root/field1')
+            hedging = policy
+        self.assertTrue(Hedged.objects.client.hedging is policy)
+
     def test_headers_field_specified_on_model_is_added_to_the_query_manager(self):
         self.assertTrue(Simple.objects.headers != None)
         self.assertEquals('user1', Simple.objects.headers['user'])
@@ -397,6 +499,47 @@ class FunctionalTest(unittest.TestCase):
         address = Address.objects.get(city="Calgary")
         self.assertEquals("Early Drive", address.street)
 
+    def test_connections_are_handed_back_when_a_query_stops_before_the_end_of_a_body(self):
+        self.server.expect(method="GET", url="/address/\w+$", times=2).and_return(mime_type="text/xml", reply_code=404, content="<error/>")
+        self.server.expect(method="HEAD", url="/counted/\w+$").and_return(mime_type="text/xml", reply_code=405)
+        self.server.expect(method="GET", url="/counted/\w+$").and_return(mime_type="text/xml", content="<addresses><address/></addresses>", headers={'X-Total-Count': '17'})
+        pool = rest_client.ConnectionPool()
+        Address.objects.client.pool = CountedAddress.objects.client.pool = pool
+        try:
+            for i in range(2):
+                self.assertRaises(DoesNotExist, Address.objects.get, city="Nowhere")
+            self.assertEquals(17, CountedAddress.objects.filter(city="Calgary").count())
+        finally:
+            Address.objects.client.pool = CountedAddress.objects.client.pool = rest_client.default_pool
+        self.assertEquals(0, pool._in_use[('http', 'localhost:8998')])
+
+    def test_latency_collector_keeps_a_histogram_per_finder_template(self):
+        self.server.expect(method="GET", url="/address/\w+$").and_return(mime_type="text/xml", content="<address><city>Calgary</city></address>")
+        collector = rest_client.LatencyCollector()
+        collector.add_model(Address)
+        Address.objects.client.add_listener(collector)
+        try:
+            Address.objects.get(city="Calgary")
+        finally:
+            Address.objects.client.remove_listener(collector)
+        self.assertEquals(1, collector.by_template["http://localhost:8998/address/%s"]['total'].count)
+
+    def test_count_is_read_from_the_count_header_of_a_head_request(self):
+        self.server.expect(method="HEAD", url="/counted/\w+$").and_return(mime_type="text/xml", headers={'X-Total-Count': '4213'})
+        self.assertEquals(4213, CountedAddress.objects.filter(city="Calgary").count())
+        self.server.expect(method="HEAD", url="/counted/\w+$").and_return(mime_type="text/xml", headers={'X-Total-Count': '0'})
+        self.assertFalse(CountedAddress.objects.filter(city="Calgary").exists())
+
+    def test_count_falls_back_to_a_get_when_head_is_not_supported(self):
+        self.server.expect(method="HEAD", url="/counted/\w+$").and_return(mime_type="text/xml", reply_code=405)
+        self.server.expect(method="GET", url="/counted/\w+$").and_return(mime_type="text/xml", content="<addresses><address/></addresses>", headers={'X-Total-Count': '17'})
+        self.assertEquals(17, CountedAddress.objects.filter(city="Calgary").count())
+
+    def test_aget_returns_a_pending_model(self):
+        self.server.expect(method="GET", url="/address/\w+$").and_return(mime_type="text/xml", content="<address><number>12</number><street>Early Drive</street><city>Calgary</city></address>")
+        pending = Address.objects.aget(city="Calgary")
+        self.assertEquals("Early Drive", pending.result().street)
+
 
 class MyValidatingModel(Model):
     muppet_name = CharField(xpath='/root/kiddie/value')
@@ -425,6 +568,13 @@ class Simple(Model):
                (field1,): "http://foo.com/simple/%s"
               }
     headers = {'user': 'user1', 'password': 'pwd1'}
+class CountedAddress(Model):
+    city = CharField(xpath='/address/city')
+
+    finders = { (city,): "http://localhost:8998/counted/%s" }
+    count_header = 'X-Total-Count'
+    head_count = True
+
 class SimpleWithoutFinder(Model):
     field1 = CharField(xpath='/root/field1')
 